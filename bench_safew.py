@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+from aiohttp import web
+
+# 离线基准测试：本地起 RSS/论坛/图床/SafeW API 替身服务，逐个规模跑一遍真实的 check_for_updates
+# 用法：python bench_safew.py --sizes 10 100 1000 --images 3 --audit-every 5 --rate-limit-every 50 --api-latency-ms 30
+#       python bench_safew.py --startup --sizes 100   # 无新帖快速路径的启动耗时守卫（python -m rss_safew）
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TID_BASE = 100000
+TID_PATTERN = re.compile(rb"thread-(\d+)\.htm")
+PHOTO_PATTERN = re.compile(rb'"type":\s*"photo"')
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+HEAVY_MODULES = ("aiohttp", "feedparser", "bs4", "selectolax")
+
+# ====================== 替身服务 =======================
+class FakeServices:
+    def __init__(self, args):
+        self.args = args
+        self.port = None
+        self.runs = {}
+
+    def run_state(self, run_id):
+        return self.runs.setdefault(run_id, {"calls": 0, "limited": 0, "received": {}, "methods": {}})
+
+    def base(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def rss(self, request):
+        size = int(request.match_info["size"])
+        etag = f'"feed-{size}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        items = "".join(
+            f"<item><title>基准帖子{tid}</title><link>{self.base()}/thread-{tid}.htm</link>"
+            f"<description>&lt;p&gt;第{tid}帖的摘要内容&lt;/p&gt;</description><author>作者{tid % 17}</author></item>"
+            for tid in range(TID_BASE + size, TID_BASE, -1)
+        )
+        body = f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>bench</title>{items}</channel></rss>'
+        return web.Response(text=body, content_type="application/rss+xml", headers={"ETag": etag})
+
+    async def thread(self, request):
+        tid = int(request.match_info["tid"])
+        if self.args.page_latency_ms:
+            await asyncio.sleep(self.args.page_latency_ms / 1000)
+        etag = f'"{tid}-v1"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        if self.args.audit_every and tid % self.args.audit_every == 0:
+            body = '<h4 class="card-title">本帖正在审核中，您无权查看</h4>'
+            return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+        count = tid % (self.args.images + 1)
+        imgs = "".join(f'<img src="/img/{tid}_{i}.png">' for i in range(count))
+        filler = "<p>正文内容</p>" * 50
+        body = (
+            f'<html><body><div class="message break-all" isfirst="1">{imgs}{filler}</div>'
+            f'<div class="message break-all"><img src="/img/reply.png">{filler}</div></body></html>'
+        )
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    async def image(self, request):
+        if self.args.image_latency_ms:
+            await asyncio.sleep(self.args.image_latency_ms / 1000)
+        name = request.match_info["name"].encode()
+        padding = self.args.image_kb * 1024 - len(PNG_HEADER) - len(name)
+        return web.Response(body=PNG_HEADER + name + b"\0" * max(0, padding), content_type="image/png")
+
+    async def api(self, request):
+        state = self.run_state(request.match_info["token"])
+        method = request.match_info["method"]
+        body = await request.read()
+        if self.args.api_latency_ms:
+            await asyncio.sleep(self.args.api_latency_ms / 1000)
+        state["calls"] += 1
+        if self.args.rate_limit_every and state["calls"] % self.args.rate_limit_every == 0:
+            state["limited"] += 1
+            payload = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                       "parameters": {"retry_after": self.args.retry_after}}
+            return web.json_response(payload, status=429)
+
+        now = time.time()
+        state["methods"][method] = state["methods"].get(method, 0) + 1
+        for tid in TID_PATTERN.findall(body):
+            state["received"].setdefault(int(tid), now)
+
+        photo = [{"file_id": f"F{state['calls']}", "width": 800, "height": 600}]
+        if method == "sendMediaGroup":
+            count = max(1, len(PHOTO_PATTERN.findall(body)))
+            result = [{"message_id": state["calls"] * 100 + i, "photo": photo} for i in range(count)]
+        elif method == "sendPhoto":
+            result = {"message_id": state["calls"] * 100, "photo": photo}
+        else:
+            result = {"message_id": state["calls"] * 100}
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_get("/rss/{size}", self.rss)
+        app.router.add_get("/thread-{tid}.htm", self.thread)
+        app.router.add_get("/img/{name}", self.image)
+        app.router.add_post("/bot{token}/{method}", self.api)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+# ====================== 被测进程 =======================
+def run_worker(args):
+    # 在独立进程里跑，保证状态、缓存和内存峰值互不干扰
+    import logging
+    import rss_safew
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    started = time.time()
+    asyncio.run(rss_safew.check_for_updates(rss_safew.load_feeds(), drain=True))
+    finished = time.time()
+    print(json.dumps({
+        "started": started,
+        "finished": finished,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+def worker_env(services, args, size, workdir):
+    run_id = f"bench{size}"
+    feeds_file = os.path.join(workdir, f"feeds_{size}.json")
+    with open(feeds_file, "w", encoding="utf-8") as f:
+        chats = [str(-1000000000000 - i) for i in range(args.chats)]
+        json.dump({"feeds": [{"name": "default", "url": f"{services.base()}/rss/{size}", "chats": chats,
+                              "forum_url": f"{services.base()}/"}]}, f)
+    env = dict(os.environ)
+    env.update({
+        "SAFEW_BOT_TOKEN": run_id,
+        "FEEDS_CONFIG_FILE": feeds_file,
+        "SAFEW_API_BASE": services.base(),
+        "FORUM_BASE_URL": f"{services.base()}/",
+        "STATE_DB_FILE": os.path.join(workdir, f"state_{size}.db"),
+        "CACHE_DIR": os.path.join(workdir, f"cache_{size}"),
+        "SEND_RATE_PER_MIN": str(args.send_rate_per_min),
+        "SEND_BURST": str(args.send_burst),
+        "DRAIN_TIME_BUDGET_SECONDS": str(args.time_budget),
+        "METRICS_JSON_FILE": os.path.join(workdir, f"summary_{size}.json"),
+    })
+    return env
+
+async def run_size(services, args, size, workdir):
+    env = worker_env(services, args, size, workdir)
+    run_id = env["SAFEW_BOT_TOKEN"]
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker"]
+    if args.verbose:
+        cmd.append("--verbose")
+    proc = await asyncio.create_subprocess_exec(*cmd, env=env, cwd=SCRIPT_DIR, stdout=asyncio.subprocess.PIPE)
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"规模{size}的被测进程退出码{proc.returncode}")
+    report = json.loads(stdout.decode().strip().splitlines()[-1])
+    with open(os.path.join(workdir, f"summary_{size}.json"), encoding="utf-8") as f:
+        run_summary = json.load(f)
+
+    state = services.run_state(run_id)
+    latencies = sorted(t - report["started"] for t in state["received"].values())
+    elapsed = report["finished"] - report["started"]
+    return {
+        "size": size,
+        "posts_sent": len(latencies),
+        "api_calls": state["calls"],
+        "rate_limited": state["limited"],
+        "methods": state["methods"],
+        "elapsed_s": round(elapsed, 3),
+        "posts_per_s": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mb": round(report["max_rss_kb"] / 1024, 1),
+        "stages": run_summary["timings"],
+    }
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+# ====================== 启动耗时 =======================
+def imported_modules(importtime_output):
+    names = set()
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            names.add(line.rsplit("|", 1)[-1].strip().split(".")[0])
+    return names
+
+async def run_process(cmd, env=None):
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, env=env, cwd=SCRIPT_DIR, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} 退出码{proc.returncode}：{stderr.decode()[-500:]}")
+    return time.perf_counter() - started, stderr.decode()
+
+async def run_startup(services, args, workdir):
+    # 先完整跑一轮写入RSS校验信息，再反复执行无新帖的单次运行，确认走快速路径且不加载重依赖
+    size = args.sizes[0]
+    await run_size(services, args, size, workdir)
+    # 用 -m 运行才能复用 __pycache__ 里的字节码（直接运行脚本每次都要重新编译约20ms），常驻主机上的cron应这样调用
+    env = worker_env(services, args, size, workdir)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    state = services.run_state(env["SAFEW_BOT_TOKEN"])
+    module = [sys.executable, "-m", "rss_safew"]
+    await run_process(module, env)
+    calls_before = state["calls"]
+
+    baseline = sorted([(await run_process([sys.executable, "-c", "pass"], env))[0] for _ in range(args.startup_runs)])
+    runs = sorted([(await run_process(module, env))[0] for _ in range(args.startup_runs)])
+    _, noop_trace = await run_process([sys.executable, "-X", "importtime", "-m", "rss_safew"], env)
+    _, import_trace = await run_process([sys.executable, "-X", "importtime", "-c", "import rss_safew"], env)
+    import_us = next(
+        (int(line.split("|")[1]) for line in import_trace.splitlines() if line.rstrip().endswith("| rss_safew")), 0
+    )
+    heavy = sorted(imported_modules(noop_trace) & set(HEAVY_MODULES))
+    result = {
+        "interpreter_ms": round(percentile(baseline, 50) * 1000, 1),
+        "noop_run_ms": round(percentile(runs, 50) * 1000, 1),
+        "noop_run_p99_ms": round(percentile(runs, 99) * 1000, 1),
+        "import_ms": round(import_us / 1000, 1),
+        "heavy_modules": heavy,
+        "api_calls": state["calls"] - calls_before,
+    }
+    print(
+        f"解释器启动{result['interpreter_ms']:.1f}ms 导入rss_safew {result['import_ms']:.1f}ms "
+        f"无新帖运行p50={result['noop_run_ms']:.1f}ms p99={result['noop_run_p99_ms']:.1f}ms "
+        f"重依赖={heavy or '无'} API调用{result['api_calls']}",
+        flush=True,
+    )
+    failures = []
+    if heavy:
+        failures.append(f"快速路径加载了{', '.join(heavy)}")
+    if result["api_calls"]:
+        failures.append("快速路径调用了SafeW API")
+    if args.startup_budget_ms and result["noop_run_ms"] - result["interpreter_ms"] > args.startup_budget_ms:
+        failures.append(f"无新帖运行超出预算{args.startup_budget_ms}ms（已扣除解释器启动）")
+    for failure in failures:
+        print(f"FAIL：{failure}", flush=True)
+    result["failures"] = failures
+    return result
+
+# ====================== 主逻辑 =======================
+async def run_bench(args):
+    services = FakeServices(args)
+    await services.start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="safew-bench-") as workdir:
+            if args.startup:
+                results.append(await run_startup(services, args, workdir))
+            for size in [] if args.startup else args.sizes:
+                result = await run_size(services, args, size, workdir)
+                results.append(result)
+                print(
+                    f"N={result['size']:<5} 发送{result['posts_sent']:<5} API调用{result['api_calls']:<5} "
+                    f"429={result['rate_limited']:<3} 耗时{result['elapsed_s']:>8.2f}s "
+                    f"吞吐{result['posts_per_s']:>7.2f}帖/s p50={result['p50_ms']:>8.1f}ms "
+                    f"p99={result['p99_ms']:>8.1f}ms 峰值内存{result['peak_rss_mb']:>6.1f}MB",
+                    flush=True,
+                )
+                if args.stages:
+                    for stage, timing in result["stages"].items():
+                        print(f"    {stage:<18} 次数{timing['count']:<6} 合计{timing['sum']:>9.3f}s "
+                              f"p50={timing['p50'] * 1000:>8.1f}ms p99={timing['p99'] * 1000:>8.1f}ms")
+    finally:
+        await services.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SafeW推送离线基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="RSS条目数，可多个")
+    parser.add_argument("--images", type=int, default=3, help="每帖最多图片数（按TID轮换0~N张）")
+    parser.add_argument("--image-kb", type=int, default=64, help="每张图片大小（KB）")
+    parser.add_argument("--audit-every", type=int, default=7, help="每隔多少个TID出现一个审核中帖子，0表示没有")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="每隔多少次API调用返回一次429，0表示不注入")
+    parser.add_argument("--retry-after", type=float, default=1, help="注入429时的retry_after（秒）")
+    parser.add_argument("--api-latency-ms", type=float, default=0)
+    parser.add_argument("--page-latency-ms", type=float, default=0)
+    parser.add_argument("--image-latency-ms", type=float, default=0)
+    parser.add_argument("--chats", type=int, default=1, help="每个帖子推送到的频道数")
+    parser.add_argument("--send-rate-per-min", type=float, default=60000, help="被测进程的发送限速")
+    parser.add_argument("--send-burst", type=int, default=20)
+    parser.add_argument("--time-budget", type=float, default=3600, help="被测进程的积压模式时间预算（秒）")
+    parser.add_argument("--json", help="把结果另存为JSON")
+    parser.add_argument("--stages", action="store_true", help="同时打印被测进程的分阶段耗时")
+    parser.add_argument("--verbose", action="store_true", help="保留被测进程的INFO日志")
+    parser.add_argument("--startup", action="store_true", help="测量无新帖时的启动耗时（取 --sizes 第一个规模预热），不达标时退出码为1")
+    parser.add_argument("--startup-runs", type=int, default=10)
+    parser.add_argument("--startup-budget-ms", type=float, default=100, help="无新帖运行扣除解释器启动后的耗时上限（目标为几十毫秒以内），0表示不检查")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        results = asyncio.run(run_bench(args))
+        if any(result.get("failures") for result in results):
+            sys.exit(1)
@@ -1,12 +1,20 @@
-import feedparser
 import logging
 import asyncio
 import json
 import os
-import aiohttp
-import uuid
 import re
-from bs4 import BeautifulSoup
+import bisect
+import heapq
+import sqlite3
+import time
+import signal
+import argparse
+import contextlib
+import importlib.util
+import concurrent.futures
+import zlib
+from collections import namedtuple
+# feedparser / bs4 / aiohttp 以及解析、上传才用到的标准库模块在用到的函数里再导入，无新帖的运行不加载
 
 # ====================== 环境配置 =======================
 SAFEW_BOT_TOKEN = os.getenv("SAFEW_BOT_TOKEN")
@@ -15,20 +23,259 @@ RSS_FEED_URL = os.getenv("RSS_FEED_URL")
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SENT_POSTS_FILE = os.path.join(SCRIPT_DIR, "sent_posts.json")
 PENDING_POSTS_FILE = os.path.join(SCRIPT_DIR, "pending_tids.json")
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", os.path.join(SCRIPT_DIR, "state.db"))
+FEEDS_CONFIG_FILE = os.getenv("FEEDS_CONFIG_FILE", os.path.join(SCRIPT_DIR, "feeds.json"))  # 多RSS/多频道订阅配置，不存在时用 RSS_FEED_URL + SAFEW_CHAT_ID
+SENT_LOG_COMPACT_LINES = int(os.getenv("SENT_LOG_COMPACT_LINES", "200"))  # 追加日志超过该条数时压缩进区间表
+OUTBOX_RESEND_UNCONFIRMED = os.getenv("OUTBOX_RESEND_UNCONFIRMED", "0") == "1"  # 上次运行中断时发送结果未知的消息是否重发（默认不重发，宁缺勿重）
+SENT_TID_WINDOW = int(os.getenv("SENT_TID_WINDOW", "5000"))  # 低于 最大TID-窗口 的TID视为已推送
 MAX_PUSH_PER_RUN = 5
-FIXED_PROJECT_URL = "https://tyw29.cc/"
+FIXED_PROJECT_URL = os.getenv("FORUM_BASE_URL", "https://tyw29.cc/")
+SAFEW_API_BASE = os.getenv("SAFEW_API_BASE", "https://api.safew.org").rstrip("/")
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
 MAX_IMAGES_PER_MSG = 10
 MAX_DESCRIPTION_LENGTH = 300  
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", "4"))  # 每个站点同时抓取的帖子页数
+IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", "4"))  # 每个图床同时下载的图片数
+IMAGE_SNIFF_BYTES = 16  # 校验文件头所需的字节数
+IMAGE_CHUNK_SIZE = 64 * 1024
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(SCRIPT_DIR, ".cache"))
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "200")) * 1024 * 1024
+PAGE_CACHE_FILE = os.path.join(CACHE_DIR, "pages.db")
+MEDIA_CACHE_FILE = os.path.join(CACHE_DIR, "media.db")  # 图片哈希 → file_id，所有订阅共用
+MEDIA_FILE_ID_TTL_DAYS = float(os.getenv("MEDIA_FILE_ID_TTL_DAYS", "30"))  # file_id超过该天数未复用则删除
+MEDIA_FILE_ID_MAX_ROWS = int(os.getenv("MEDIA_FILE_ID_MAX_ROWS", "2000"))  # 最多保留的file_id条数
+PAGE_CACHE_TTL_HOURS = float(os.getenv("PAGE_CACHE_TTL_HOURS", "24"))  # 帖子页解析结果超过该时长未验证则丢弃
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "5000"))
+MAX_UPLOAD_BYTES_PER_MSG = int(os.getenv("MAX_UPLOAD_MB_PER_MSG", "0")) * 1024 * 1024  # 0 表示不限
+PAGE_PARSER = os.getenv("PAGE_PARSER", "auto")  # 帖子页解析器：auto / stream / selectolax / bs4
+CPU_POOL = os.getenv("CPU_POOL", "thread")  # RSS/帖子页解析的执行方式：thread / process / inline
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0"))  # 0 表示按可用CPU核数
+SEND_RATE_PER_MIN = float(os.getenv("SEND_RATE_PER_MIN", "20"))  # 每个会话每分钟发送上限
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))  # 空闲时可连续发送的条数
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "4"))
+SEND_BACKOFF_BASE = 2.0
+SEND_BACKOFF_MAX = 60.0
+PENDING_RECHECK_BASE_SECONDS = int(os.getenv("PENDING_RECHECK_BASE_SECONDS", "300"))  # 待审核帖首次复查间隔，之后每次翻倍
+PENDING_RECHECK_MAX_SECONDS = int(os.getenv("PENDING_RECHECK_MAX_SECONDS", str(6 * 3600)))  # 复查间隔上限
+PENDING_MAX_AGE_HOURS = float(os.getenv("PENDING_MAX_AGE_HOURS", "0"))  # 待审核超过该时长则放弃，0 表示永不放弃
+RSS_INCREMENTAL = os.getenv("RSS_INCREMENTAL", "0") == "1"  # 按TID高水位增量处理RSS
+FEED_CHUNK_SIZE = 64 * 1024
+DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
+QUICK_CHECK = os.getenv("QUICK_CHECK", "1") == "1"  # 单次运行先用标准库发条件请求，无到期待审核且RSS未变化时直接结束
+DRAIN_MODE = os.getenv("DRAIN_MODE", "0") == "1"  # 积压模式，也可用 --drain 开启
+DRAIN_TIME_BUDGET_SECONDS = float(os.getenv("DRAIN_TIME_BUDGET_SECONDS", "360"))  # 积压模式下单轮推送时长上限
+DRAIN_DIGEST = os.getenv("DRAIN_DIGEST", "0") == "1"  # 积压模式下把连续的纯文本帖合并成一条摘要
+DIGEST_MAX_POSTS = 10
+DIGEST_MAX_CHARS = 4000
+POLL_MIN_SECONDS = float(os.getenv("POLL_MIN_SECONDS", "60"))  # 常驻模式：有新帖时的轮询间隔
+POLL_MAX_SECONDS = float(os.getenv("POLL_MAX_SECONDS", "600"))  # 常驻模式：空闲时最长轮询间隔
+POLL_BACKOFF_FACTOR = 1.5
+METRICS_JSON_FILE = os.getenv("METRICS_JSON_FILE", os.path.join(SCRIPT_DIR, "run_summary.json"))  # 每轮运行指标汇总，留空则不写
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "")  # Prometheus textfile 路径（node_exporter textfile collector），留空则不写
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))  # DNS缓存秒数
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30"))  # 空闲连接保持时长
+HTTP_CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", "2"))  # 论坛/图床建立连接失败时的重试次数
+HTTP_CONNECT_RETRY_DELAY = 0.5
+HTTP_PROFILES = {
+    # 每类主机独立连接池：limit 总连接数，limit_per_host 单主机连接数；超时单位秒，None 表示不限
+    "forum": {"limit": 16, "limit_per_host": PAGE_FETCH_CONCURRENCY, "connect": 10, "sock_read": 20, "total": 40,
+              "connect_retries": HTTP_CONNECT_RETRIES},
+    "images": {"limit": 32, "limit_per_host": IMAGE_FETCH_CONCURRENCY, "connect": 10, "sock_read": 15, "total": 60,
+               "connect_retries": HTTP_CONNECT_RETRIES},
+    # API请求可能已送达，连接重试交给 SendScheduler 统一处理
+    "api": {"limit": 8, "limit_per_host": 4, "connect": 10, "sock_read": 30, "total": None, "connect_retries": 0},
+}
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
 
 # ====================== 日志配置 =======================
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
-logging.info(f"脚本目录：{SCRIPT_DIR}")
-logging.info(f"已推送文件路径：{SENT_POSTS_FILE}")
-logging.info(f"待审核文件路径：{PENDING_POSTS_FILE}")
+
+# ====================== 运行指标 =======================
+class Histogram:
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def quantile(self, q):
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+    def summary(self):
+        return {
+            "count": len(self.values),
+            "sum": round(sum(self.values), 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(max(self.values, default=0.0), 6),
+        }
+
+    def buckets(self):
+        return [(le, sum(1 for v in self.values if v <= le)) for le in METRICS_BUCKETS]
+
+class RunMetrics:
+    # 单轮运行的计数器和分阶段耗时；每轮结束写JSON汇总，可选写Prometheus textfile
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.counters = {}
+        self.timings = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        self.timings.setdefault(stage, Histogram()).observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def summary(self):
+        return {
+            "started_at": int(self.started),
+            "duration_seconds": round(time.time() - self.started, 3),
+            "counters": dict(sorted(self.counters.items())),
+            "timings": {stage: hist.summary() for stage, hist in sorted(self.timings.items())},
+        }
+
+    def prometheus_text(self):
+        lines = [
+            "# TYPE safew_last_run_timestamp_seconds gauge",
+            f"safew_last_run_timestamp_seconds {int(self.started)}",
+            "# TYPE safew_run_duration_seconds gauge",
+            f"safew_run_duration_seconds {time.time() - self.started:.3f}",
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE safew_{name}_total counter")
+            lines.append(f"safew_{name}_total {value}")
+        if self.timings:
+            lines.append("# TYPE safew_stage_seconds histogram")
+        for stage, hist in sorted(self.timings.items()):
+            for le, count in hist.buckets():
+                lines.append(f'safew_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'safew_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(hist.values)}')
+            lines.append(f'safew_stage_seconds_sum{{stage="{stage}"}} {sum(hist.values):.6f}')
+            lines.append(f'safew_stage_seconds_count{{stage="{stage}"}} {len(hist.values)}')
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        # 先写临时文件再替换，避免采集方读到半个文件
+        outputs = [(METRICS_JSON_FILE, lambda: json.dumps(self.summary(), ensure_ascii=False, indent=2)),
+                   (METRICS_PROM_FILE, self.prometheus_text)]
+        for path, render in outputs:
+            if not path:
+                continue
+            try:
+                tmp = f"{path}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(render())
+                os.replace(tmp, path)
+            except OSError as e:
+                logging.warning(f"写入运行指标失败（{path}）：{str(e)}")
+
+metrics = RunMetrics()
+
+# ====================== HTTP传输 =======================
+ACCEPT_ENCODING = "gzip, deflate, br" if importlib.util.find_spec("brotli") or importlib.util.find_spec("brotlicffi") else "gzip, deflate"
+
+class Transport:
+    # 论坛（RSS+帖子页）、图床、SafeW API 各用一个会话，连接池/超时/重试互不影响
+    def __init__(self, profiles=None):
+        self.profiles = profiles or HTTP_PROFILES
+        self.sessions = {}
+
+    async def __aenter__(self):
+        import aiohttp
+        for kind, profile in self.profiles.items():
+            connector = aiohttp.TCPConnector(
+                limit=profile["limit"],
+                limit_per_host=max(1, profile["limit_per_host"]),
+                ttl_dns_cache=HTTP_DNS_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=profile["total"], connect=profile["connect"], sock_read=profile["sock_read"]
+            )
+            self.sessions[kind] = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={"User-Agent": USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING},
+            )
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.gather(*(s.close() for s in self.sessions.values()))
+        self.sessions = {}
+
+    @contextlib.asynccontextmanager
+    async def request(self, kind, method, url, **kwargs):
+        import aiohttp
+        retries = self.profiles[kind]["connect_retries"]
+        for attempt in range(retries + 1):
+            try:
+                resp = await self.sessions[kind].request(method, url, **kwargs)
+                break
+            except aiohttp.ClientConnectorError as e:
+                if attempt >= retries:
+                    raise
+                delay = HTTP_CONNECT_RETRY_DELAY * (2 ** attempt)
+                metrics.inc("http_connect_retries")
+                logging.warning(f"连接{url.split('/')[2] if '//' in url else url}失败：{str(e)}，{delay:.1f}秒后重试")
+                await asyncio.sleep(delay)
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    def get(self, kind, url, **kwargs):
+        return self.request(kind, "GET", url, **kwargs)
+
+    def post(self, kind, url, **kwargs):
+        return self.request(kind, "POST", url, **kwargs)
+
+# ====================== CPU任务池 =======================
+_cpu_executor = None
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+def get_cpu_executor():
+    global _cpu_executor
+    if _cpu_executor is None and CPU_POOL in ("thread", "process"):
+        workers = CPU_POOL_WORKERS or available_cpus()
+        if CPU_POOL == "process":
+            _cpu_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            _cpu_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="safew-cpu")
+        logging.info(f"CPU任务池：{CPU_POOL} × {workers}")
+    return _cpu_executor
+
+async def run_cpu(func, *args):
+    # 解析等CPU密集任务移出事件循环；process 模式下 func 须为模块级函数，参数和返回值须可pickle
+    executor = get_cpu_executor()
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+def shutdown_cpu_executor():
+    global _cpu_executor
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=True, cancel_futures=True)
+        _cpu_executor = None
 
 # ====================== 工具函数 =======================
 def get_image_content_type(filename):
@@ -50,91 +297,377 @@ def is_valid_image(data):
     return False
 
 # ====================== TID管理 =======================
-def load_sent_tids():
-    try:
-        if not os.path.exists(SENT_POSTS_FILE):
-            with open(SENT_POSTS_FILE, "w", encoding="utf-8") as f:
-                json.dump([], f)
-            logging.info(f"初始化已推送文件：{SENT_POSTS_FILE}")
-            return []
-        with open(SENT_POSTS_FILE, "r", encoding="utf-8") as f:
-            tids = json.loads(f.read().strip() or "[]")
-            return [int(t) for t in tids if isinstance(t, int)]
-    except Exception as e:
-        logging.error(f"读取已推送TID失败：{str(e)}")
-        return []
+class SentTidIndex:
+    # 已推送TID按连续区间存储；<= floor 的TID一律视为已推送，不再占用内存
+    def __init__(self, ranges=(), floor=0):
+        self.floor = floor
+        self.starts = []
+        self.ends = []
+        self.log_lines = 0
+        for start, end in sorted(ranges):
+            if end > floor:
+                self._merge_range(max(start, floor + 1), end)
 
-def save_sent_tids(new_tids, existing_tids):
-    try:
-        all_tids = sorted(list(set(existing_tids + new_tids)))
-        with open(SENT_POSTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(all_tids, f, ensure_ascii=False, indent=2)
-        logging.info(f"已推送TID更新：新增{len(new_tids)}条，总计{len(all_tids)}条")
-    except Exception as e:
-        logging.error(f"保存已推送TID失败：{str(e)}")
+    def __contains__(self, tid):
+        if tid <= self.floor:
+            return True
+        i = bisect.bisect_right(self.starts, tid) - 1
+        return i >= 0 and self.ends[i] >= tid
 
-def load_pending_data():
-    try:
-        if not os.path.exists(PENDING_POSTS_FILE):
-            with open(PENDING_POSTS_FILE, "w", encoding="utf-8") as f:
-                json.dump([], f)
-            logging.info(f"初始化待审核文件：{PENDING_POSTS_FILE}")
-            return []
-        if not os.access(PENDING_POSTS_FILE, os.R_OK):
-            raise PermissionError(f"无读取权限：{PENDING_POSTS_FILE}")
-        with open(PENDING_POSTS_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip() or "[]"
-            data = json.loads(content)
-        valid_data = []
-        for item in data:
-            if isinstance(item, dict) and "tid" in item:
-                valid_item = {
-                    "tid": int(item["tid"]),
-                    "title": item.get("title", "无标题"),
-                    "author": item.get("author", "未知用户"),
-                    "description": item.get("description", "无描述")  
-                }
-                valid_data.append(valid_item)
-            elif isinstance(item, int): 
-                valid_data.append({
-                    "tid": item,
-                    "title": "无标题",
-                    "author": "未知用户",
-                    "description": "无描述"
-                })
-        logging.info(f"读取待审核数据：共{len(valid_data)}条 → TID列表：{[d['tid'] for d in valid_data]}")
-        return valid_data
-    except Exception as e:
-        logging.error(f"读取待审核数据失败：{str(e)}")
-        return []
+    def __len__(self):
+        return sum(e - s + 1 for s, e in zip(self.starts, self.ends))
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    def _merge_range(self, start, end):
+        # 与前后相邻/重叠的区间合并
+        i = bisect.bisect_left(self.starts, start)
+        lo = i - 1 if i > 0 and self.ends[i - 1] >= start - 1 else i
+        hi = i
+        while hi < len(self.starts) and self.starts[hi] <= end + 1:
+            hi += 1
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def add(self, tid):
+        if tid in self:
+            return False
+        self._merge_range(tid, tid)
+        return True
+
+    @property
+    def max_tid(self):
+        return self.ends[-1] if self.ends else self.floor
+
+    def ranges(self):
+        return [[s, e] for s, e in zip(self.starts, self.ends)]
+
+    def trim(self, window):
+        # 高水位：低于 最大TID-window 的区间并入floor后丢弃
+        new_floor = self.max_tid - window
+        if window <= 0 or new_floor <= self.floor:
+            return
+        i = bisect.bisect_right(self.ends, new_floor)
+        del self.starts[:i], self.ends[:i]
+        if self.starts and self.starts[0] <= new_floor:
+            self.starts[0] = new_floor + 1
+        self.floor = new_floor
+
+def normalize_pending_item(item):
+    if isinstance(item, int):
+        item = {"tid": item}
+    if isinstance(item, dict) and "tid" in item:
+        return {
+            "tid": int(item["tid"]),
+            "title": (item.get("title") or "无标题").strip(),
+            "author": (item.get("author") or "未知用户").strip(),
+            "description": (item.get("description") or "无描述").strip(),
+            "attempts": int(item.get("attempts") or 0),
+            "first_seen": int(item.get("first_seen") or time.time()),
+            "next_check_at": int(item.get("next_check_at") or 0)
+        }
+    return None
 
-def save_pending_data(data):
+def pending_recheck_delay(attempts):
+    return min(PENDING_RECHECK_MAX_SECONDS, PENDING_RECHECK_BASE_SECONDS * (2 ** attempts))
+
+def read_legacy_state():
+    # 迁移用：读取旧版 sent_posts.json（TID数组）和 pending_tids.json
+    sent = SentTidIndex()
+    pending = []
     try:
-        unique_data = []
-        seen_tids = set()
-        for item in sorted(data, key=lambda x: x["tid"]):
-            tid = item["tid"]
-            if tid not in seen_tids:
-                seen_tids.add(tid)
-                unique_data.append({
-                    "tid": tid,
-                    "title": item.get("title", "无标题").strip(),
-                    "author": item.get("author", "未知用户").strip(),
-                    "description": item.get("description", "无描述").strip()
-                })
-        temp_file = f"{PENDING_POSTS_FILE}.tmp"
-        with open(temp_file, "w", encoding="utf-8") as f:
-            json.dump(unique_data, f, ensure_ascii=False, indent=2)
-        os.replace(temp_file, PENDING_POSTS_FILE)
-        logging.info(f"待审核数据更新：共{len(unique_data)}条 → TID列表：{[d['tid'] for d in unique_data]}")
+        if os.path.exists(SENT_POSTS_FILE):
+            with open(SENT_POSTS_FILE, "r", encoding="utf-8") as f:
+                data = json.loads(f.read().strip() or "[]")
+            for t in data if isinstance(data, list) else []:
+                if isinstance(t, int):
+                    sent.add(t)
+        if os.path.exists(PENDING_POSTS_FILE):
+            with open(PENDING_POSTS_FILE, "r", encoding="utf-8") as f:
+                data = json.loads(f.read().strip() or "[]")
+            pending = [item for item in map(normalize_pending_item, data) if item]
     except Exception as e:
-        logging.error(f"保存待审核数据失败：{str(e)}")
+        logging.error(f"读取旧版状态文件失败：{str(e)}")
+    return sent, pending
+
+# ====================== 状态存储 =======================
+PENDING_UPSERT_SQL = (
+    "INSERT OR REPLACE INTO pending (tid, title, author, description, attempts, first_seen, next_check_at) "
+    "VALUES (:tid, :title, :author, :description, :attempts, :first_seen, :next_check_at)"
+)
+
+class StateStore:
+    # 单次运行只打开一次；修改先记在内存，commit() 时在一个事务里批量落盘
+    def __init__(self, path=STATE_DB_FILE, feed_url=None):
+        self.path = path
+        self.feed_url = feed_url or RSS_FEED_URL
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sent_ranges (start INTEGER PRIMARY KEY, end INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS sent_log (tid INTEGER PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS pending (
+                    tid INTEGER PRIMARY KEY, title TEXT, author TEXT, description TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0, first_seen INTEGER NOT NULL DEFAULT 0,
+                    next_check_at INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS outbox (
+                    tid INTEGER NOT NULL, chat_id TEXT NOT NULL, state TEXT NOT NULL, message_ids TEXT,
+                    updated_at INTEGER NOT NULL, PRIMARY KEY (tid, chat_id)
+                );
+            """)
+        self.new_sent = []
+        self.pending_upserts = {}
+        self.pending_deletes = set()
+        self.meta_updates = {}
+        self.outbox_deletes = set()
+        if is_new and path == STATE_DB_FILE:
+            self._migrate_legacy()
+        self._load()
+
+    def _migrate_legacy(self):
+        sent, pending = read_legacy_state()
+        if not (len(sent) or pending):
+            return
+        with self.conn:
+            self.conn.executemany("INSERT INTO sent_ranges VALUES (?, ?)", sent.ranges())
+            self.conn.executemany(PENDING_UPSERT_SQL, pending)
+        logging.info(f"已从旧版JSON迁移状态：已推送{len(sent)}条，待审核{len(pending)}条")
+
+    def _load(self):
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        self.meta = meta
+        ranges = self.conn.execute("SELECT start, end FROM sent_ranges ORDER BY start").fetchall()
+        self.sent = SentTidIndex(ranges, int(meta.get("sent_floor") or 0))
+        for (tid,) in self.conn.execute("SELECT tid FROM sent_log"):
+            self.sent.add(tid)
+            self.sent.log_lines += 1
+        self.pending = {}
+        now = int(time.time())
+        rows = self.conn.execute(
+            "SELECT tid, title, author, description, attempts, first_seen, next_check_at FROM pending"
+        )
+        for tid, title, author, description, attempts, first_seen, next_check_at in rows:
+            self.pending[tid] = {
+                "tid": tid, "title": title, "author": author, "description": description,
+                "attempts": attempts, "first_seen": first_seen or now, "next_check_at": next_check_at
+            }
+            if not first_seen:
+                self.pending_upserts[tid] = self.pending[tid]
+        self.pending_heap = [(item["next_check_at"], tid) for tid, item in self.pending.items()]
+        heapq.heapify(self.pending_heap)
+        self._reconcile_outbox()
+        logging.info(f"状态已加载：已推送{len(self.sent)}条（floor={self.sent.floor}），待审核{len(self.pending)}条")
+
+    def _reconcile_outbox(self):
+        # 仍是sending的记录说明上次运行在发送途中被中断，消息可能已经送达
+        self.outbox = {}
+        unconfirmed = []
+        for tid, chat_id, state in self.conn.execute("SELECT tid, chat_id, state FROM outbox"):
+            if state == "sending":
+                unconfirmed.append((tid, chat_id))
+                state = "unconfirmed"
+            self.outbox.setdefault(tid, {})[chat_id] = state
+        if not unconfirmed:
+            return
+        with self.conn:
+            if OUTBOX_RESEND_UNCONFIRMED:
+                self.conn.executemany("DELETE FROM outbox WHERE tid = ? AND chat_id = ?", unconfirmed)
+            else:
+                self.conn.executemany(
+                    "UPDATE outbox SET state = 'unconfirmed' WHERE tid = ? AND chat_id = ?", unconfirmed
+                )
+        for tid, chat_id in unconfirmed:
+            if OUTBOX_RESEND_UNCONFIRMED:
+                self.outbox[tid].pop(chat_id)
+                logging.warning(f"TID={tid} 上次发送到{chat_id}时中断，结果未知，将重新发送")
+            else:
+                logging.warning(f"TID={tid} 上次发送到{chat_id}时中断，结果未知，按已送达处理不再重发")
+
+    def _write_meta(self, values):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", [(k, None if v is None else str(v)) for k, v in values.items()]
+        )
+
+    def _validator_meta(self, validators):
+        validators = validators or {}
+        return {
+            "feed_url": self.feed_url,
+            "feed_etag": validators.get("etag"),
+            "feed_last_modified": validators.get("last_modified")
+        }
+
+    # ---------- 已推送 ----------
+    def mark_sent(self, tid):
+        if self.sent.add(tid):
+            self.new_sent.append(tid)
+            metrics.inc("posts_sent")
+        if self.outbox.pop(tid, None) is not None:
+            self.outbox_deletes.add(tid)
+        self.remove_pending(tid)
+
+    # ---------- 发送日志（先写意图再发送，结果立即落盘，不等commit）----------
+    def delivered_chats(self, tid):
+        return {c for c, state in self.outbox.get(tid, {}).items() if state in ("sent", "unconfirmed")}
+
+    def _write_outbox(self, tids, chat_id, state, message_ids=None):
+        now = int(time.time())
+        with metrics.timer("outbox_write"), self.conn:
+            if state is None:
+                self.conn.executemany("DELETE FROM outbox WHERE tid = ? AND chat_id = ?", [(t, chat_id) for t in tids])
+            else:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?)",
+                    [(t, chat_id, state, message_ids, now) for t in tids]
+                )
+        for tid in tids:
+            if state is None:
+                self.outbox.get(tid, {}).pop(chat_id, None)
+            else:
+                self.outbox.setdefault(tid, {})[chat_id] = state
+
+    def outbox_journal(self, tids, chat_id):
+        # 交给 SendScheduler.call：每次POST前写sending，确定未送达（连接失败/4xx）时删除
+        return lambda sending: self._write_outbox(tids, chat_id, "sending" if sending else None)
+
+    def outbox_in_flight(self, tids, chat_id):
+        return any(self.outbox.get(t, {}).get(chat_id) == "sending" for t in tids)
+
+    def outbox_done(self, tids, chat_id, message_ids):
+        self._write_outbox(tids, chat_id, "sent", json.dumps(message_ids))
+
+    def outbox_unconfirmed(self, tids, chat_id):
+        self._write_outbox(tids, chat_id, "unconfirmed")
+
+    def outbox_abort(self, tids, chat_id):
+        self._write_outbox(tids, chat_id, None)
+
+    # ---------- 待审核 ----------
+    def add_pending(self, item):
+        # 新加入的待审核帖刚检查过，按第一档间隔排期
+        scheduled = isinstance(item, dict) and item.get("next_check_at")
+        item = normalize_pending_item(item)
+        if not scheduled:
+            item["next_check_at"] = int(time.time()) + pending_recheck_delay(0)
+        self._put_pending(item)
+
+    def _put_pending(self, item):
+        self.pending[item["tid"]] = item
+        self.pending_upserts[item["tid"]] = item
+        self.pending_deletes.discard(item["tid"])
+        heapq.heappush(self.pending_heap, (item["next_check_at"], item["tid"]))
+
+    def due_pending(self, now=None):
+        # 从优先队列中取出所有已到期的待审核帖；取出后须调用 reschedule_pending / remove_pending / mark_sent
+        now = int(time.time()) if now is None else now
+        due = []
+        while self.pending_heap and self.pending_heap[0][0] <= now:
+            check_at, tid = heapq.heappop(self.pending_heap)
+            item = self.pending.get(tid)
+            if item is not None and item["next_check_at"] == check_at:
+                due.append(item)
+        return sorted(due, key=lambda x: x["tid"])
+
+    def next_pending_check_at(self):
+        while self.pending_heap:
+            check_at, tid = self.pending_heap[0]
+            item = self.pending.get(tid)
+            if item is not None and item["next_check_at"] == check_at:
+                return check_at
+            heapq.heappop(self.pending_heap)
+        return None
+
+    def reschedule_pending(self, tid, backoff=True):
+        item = dict(self.pending[tid])
+        if backoff:
+            item["attempts"] += 1
+        item["next_check_at"] = int(time.time()) + pending_recheck_delay(item["attempts"])
+        self._put_pending(item)
+        return item["next_check_at"]
+
+    def remove_pending(self, tid):
+        if self.pending.pop(tid, None) is not None:
+            self.pending_upserts.pop(tid, None)
+            self.pending_deletes.add(tid)
+
+    # ---------- RSS校验信息 ----------
+    def feed_validators(self):
+        if self.meta.get("feed_url") != self.feed_url:
+            return {}
+        return {
+            k: self.meta[f"feed_{k}"] for k in ("etag", "last_modified") if self.meta.get(f"feed_{k}")
+        }
+
+    def set_feed_validators(self, validators):
+        values = self._validator_meta(validators)
+        self.meta.update(values)
+        self.meta_updates.update(values)
+
+    def feed_high_water(self):
+        if self.meta.get("feed_hw_url") != self.feed_url:
+            return 0
+        return int(self.meta.get("feed_high_water") or 0)
+
+    def set_feed_high_water(self, tid):
+        values = {"feed_hw_url": self.feed_url, "feed_high_water": str(tid)}
+        self.meta.update(values)
+        self.meta_updates.update(values)
+
+    # ---------- 落盘 ----------
+    def commit(self):
+        if not (self.new_sent or self.pending_upserts or self.pending_deletes or self.meta_updates
+                or self.outbox_deletes):
+            return
         try:
-            with open(PENDING_POSTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(unique_data, f, ensure_ascii=False, indent=2)
-            logging.warning("备用方案：待审核数据已写入")
-        except:
-            pass
+            with metrics.timer("state_commit"), self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO sent_log VALUES (?)", [(t,) for t in self.new_sent])
+                self.sent.log_lines += len(self.new_sent)
+                self.conn.executemany("DELETE FROM pending WHERE tid = ?", [(t,) for t in self.pending_deletes])
+                self.conn.executemany(PENDING_UPSERT_SQL, list(self.pending_upserts.values()))
+                if self.meta_updates:
+                    self._write_meta(self.meta_updates)
+                self.conn.executemany("DELETE FROM outbox WHERE tid = ?", [(t,) for t in self.outbox_deletes])
+                if self.sent.log_lines >= SENT_LOG_COMPACT_LINES:
+                    self._compact_sent()
+            logging.info(
+                f"状态已提交：新增已推送{len(self.new_sent)}条，待审核+{len(self.pending_upserts)}/-{len(self.pending_deletes)}条"
+            )
+            self.new_sent = []
+            self.pending_upserts = {}
+            self.pending_deletes = set()
+            self.meta_updates = {}
+            self.outbox_deletes = set()
+        except Exception as e:
+            logging.error(f"提交状态失败：{str(e)}")
+            raise
+
+    def _compact_sent(self):
+        # 在commit的事务内执行：日志并入区间表，低于高水位的区间并入floor
+        self.sent.trim(SENT_TID_WINDOW)
+        self.conn.execute("DELETE FROM sent_ranges")
+        self.conn.executemany("INSERT INTO sent_ranges VALUES (?, ?)", self.sent.ranges())
+        self.conn.execute("DELETE FROM sent_log")
+        self.conn.execute("DELETE FROM outbox WHERE tid <= ?", (self.sent.floor,))
+        self._write_meta({"sent_floor": self.sent.floor})
+        self.sent.log_lines = 0
+        logging.info(f"已推送TID已压缩：{len(self.sent.starts)}个区间，floor={self.sent.floor}")
+
+    def close(self):
+        try:
+            self.commit()
+            with metrics.timer("state_checkpoint"):
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            self.conn.close()
 
 # ====================== TID提取/RSS获取（核心修改）======================
 def extract_tid_from_url(url):
@@ -145,97 +678,751 @@ def extract_tid_from_url(url):
         logging.error(f"提取TID失败：{str(e)}")
         return None
 
-def fetch_updates(sent_tids, pending_tids):
+def _strip_html(text):
+    return re.sub(r'<[^>]+>', '', text)
+
+class RssItemStream:
+    # 增量解析RSS 2.0：TID<=高水位的条目只读link，不提取标题/作者/描述；
+    # 若RSS按TID降序排列，遇到第一条旧帖即停止，剩余部分无需下载
+    def __init__(self, high_water=0):
+        import xml.etree.ElementTree as ET
+        self.parser = ET.XMLPullParser(events=("end",))
+        self.high_water = high_water
+        self.items = []
+        self.max_tid = 0
+        self.last_tid = None
+        self.descending = True
+        self.seen_item = False
+        self.stopped = False
+        self.failed = False
+
+    def feed(self, chunk):
+        # 返回True表示无需再读：已到高水位或解析失败
+        import xml.etree.ElementTree as ET
+        try:
+            self.parser.feed(chunk)
+            for _, elem in self.parser.read_events():
+                if elem.tag == "item" and self._take(elem):
+                    self.stopped = True
+                    return True
+                if elem.tag == "item":
+                    elem.clear()
+        except ET.ParseError as e:
+            logging.warning(f"RSS流式解析失败：{str(e)}")
+            self.failed = True
+            return True
+        return False
+
+    def _take(self, elem):
+        self.seen_item = True
+        link = (elem.findtext("link") or "").strip()
+        tid = extract_tid_from_url(link) if link else None
+        if not tid:
+            return False
+        self.max_tid = max(self.max_tid, tid)
+        self.descending = self.descending and (self.last_tid is None or tid < self.last_tid)
+        self.last_tid = tid
+        if tid > self.high_water:
+            author = elem.findtext("author") or elem.findtext(f"{{{DC_NAMESPACE}}}creator")
+            self.items.append({
+                "tid": tid,
+                "link": link,
+                "rss_title": (elem.findtext("title") or "无标题").strip(),
+                "rss_author": author.strip() if (author and author.strip()) else "未知用户",
+                "rss_description": _strip_html((elem.findtext("description") or "无描述").strip())
+            })
+            return False
+        return self.descending and bool(self.high_water)
+
+    def result(self):
+        # 返回 (条目列表, RSS中最大TID)，无法解析时返回None
+        import xml.etree.ElementTree as ET
+        if not (self.stopped or self.failed):
+            try:
+                self.parser.close()
+            except ET.ParseError as e:
+                logging.warning(f"RSS流式解析失败：{str(e)}")
+                self.failed = True
+        if self.failed or not self.seen_item:
+            return None
+        return self.items, self.max_tid
+
+async def stream_rss_items(resp, high_water):
+    # 边下载边解析，到高水位即断开连接；返回 (已读取的body, 解析结果)，解析失败时读完全文、结果为None
+    stream = RssItemStream(high_water)
+    chunks = []
+    async for chunk in resp.content.iter_chunked(FEED_CHUNK_SIZE):
+        chunks.append(chunk)
+        if stream.feed(chunk):
+            break
+    parsed = stream.result()
+    if parsed is None:
+        chunks.append(await resp.read())
+    elif stream.stopped:
+        metrics.inc("rss_stream_stopped")
+        resp.close()
+    return b"".join(chunks), parsed
+
+def parse_feedparser_items(body, response_headers, sent_tids, pending_tids):
+    import feedparser
+    feed = feedparser.parse(body, response_headers=response_headers)
+    if feed.bozo:
+        logging.error(f"RSS解析失败：{feed.bozo_exception}")
+        return None
+    items = []
+    max_tid = 0
+    for entry in feed.entries:
+        link = entry.get("link", "").strip()
+        if not link:
+            continue
+        tid = extract_tid_from_url(link)
+        if not tid:
+            continue
+        max_tid = max(max_tid, tid)
+        if tid in sent_tids or tid in pending_tids:
+            continue
+        author = entry.get("author") or entry.get("dc_author") or \
+                 entry.get("dc", {}).get("creator") or entry.get("dc_creator") or entry.get("creator")
+        items.append({
+            "tid": tid,
+            "link": link,
+            "rss_title": entry.get("title", "无标题").strip(),
+            "rss_author": author.strip() if (author and str(author).strip()) else "未知用户",
+            "rss_description": _strip_html(entry.get("description", "无描述").strip())
+        })
+        logging.debug(f"TID={tid} 作者提取：{items[-1]['rss_author']}（来源：author/dc_author等）")
+    return items, max_tid
+
+async def fetch_updates(http, store, feed, prefetched=None):
+    # 返回 (新帖列表, 本次RSS的校验信息, RSS中最大TID)；RSS未变化时返回 ([], None, 0)，异常时返回 (None, None, 0)
+    # prefetched 为快速检查时已取回的 (body, headers, 增量解析结果)，有则不再重复请求
     try:
+        sent_tids, pending_tids = store.sent, store.pending
         logging.info(f"筛选RSS新帖：排除已推送{len(sent_tids)}条 + 待审核{len(pending_tids)}条")
-        feed = feedparser.parse(RSS_FEED_URL)
-        if feed.bozo:
-            logging.error(f"RSS解析失败：{feed.bozo_exception}")
-            return None
-        
-        valid_entries = []
-        for entry in feed.entries:
-            link = entry.get("link", "").strip()
-            if not link:
-                continue
-            tid = extract_tid_from_url(link)
-            if not tid:
-                continue
-            if tid not in sent_tids and tid not in pending_tids:
-                entry["tid"] = tid
-                entry["rss_title"] = entry.get("title", "无标题").strip() 
-                author = entry.get("author") or entry.get("dc_author") or \
-                         entry.get("dc", {}).get("creator") or entry.get("dc_creator") or entry.get("creator")
-                entry["rss_author"] = author.strip() if (author and str(author).strip()) else "未知用户"
-                desc = entry.get("description", "无描述").strip()
-                entry["rss_description"] = re.sub(r'<[^>]+>', '', desc)  
-                logging.debug(f"TID={tid} 作者提取：{entry['rss_author']}（来源：author/dc_author等）")
-                valid_entries.append(entry)
-        
+        validators = store.feed_validators()
+        headers = {"Accept": "application/rss+xml, application/xml;q=0.9, */*;q=0.8"}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        high_water = store.feed_high_water() if RSS_INCREMENTAL else 0
+        parsed = None
+        if prefetched is not None:
+            body, resp_headers, parsed = prefetched
+        else:
+            fetch_started = time.perf_counter()
+            async with http.get("forum", feed.url, headers=headers) as resp:
+                if resp.status == 304:
+                    metrics.observe("rss_fetch", time.perf_counter() - fetch_started)
+                    metrics.inc("rss_not_modified")
+                    logging.info("RSS未变化（304），跳过解析")
+                    return [], None, 0
+                if resp.status != 200:
+                    metrics.inc("rss_errors")
+                    logging.error(f"RSS请求失败（状态码：{resp.status}）")
+                    return None, None, 0
+                resp_headers = resp.headers
+                if RSS_INCREMENTAL:
+                    body, parsed = await stream_rss_items(resp, high_water)
+                else:
+                    body = await resp.read()
+            metrics.observe("rss_fetch", time.perf_counter() - fetch_started)
+            metrics.inc("rss_bytes", len(body))
+        new_validators = {
+            k: v for k, v in (("etag", resp_headers.get("ETag")), ("last_modified", resp_headers.get("Last-Modified"))) if v
+        }
+        response_headers = {"content-type": resp_headers.get("Content-Type", ""), "content-location": feed.url}
+
+        if RSS_INCREMENTAL and parsed is None:
+            logging.warning("增量解析不可用，改用feedparser完整解析")
+        elif RSS_INCREMENTAL:
+            logging.info(f"增量解析：高水位TID={high_water}，高于水位的条目{len(parsed[0])}条，读取{len(body)}字节")
+        if parsed is None:
+            with metrics.timer("rss_parse"):
+                parsed = await run_cpu(parse_feedparser_items, body, response_headers, sent_tids, set(pending_tids))
+            if parsed is None:
+                return None, None, 0
+        items, max_tid = parsed
+        metrics.inc("rss_items", len(items))
+
+        valid_entries = [item for item in items if item["tid"] not in sent_tids and item["tid"] not in pending_tids]
+        metrics.inc("rss_new_entries", len(valid_entries))
         logging.info(f"RSS筛选完成：共{len(valid_entries)}条全新待推送帖")
-        return sorted(valid_entries, key=lambda x: x["tid"])
+        return sorted(valid_entries, key=lambda x: x["tid"]), new_validators, max_tid
     except Exception as e:
+        metrics.inc("rss_errors")
         logging.error(f"获取RSS异常：{str(e)}")
+        return None, None, 0
+
+def read_feed_body(resp, high_water=None):
+    # urllib版的 stream_rss_items：gzip边读边解压；high_water 为None时不做增量解析，读完全文
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if resp.headers.get("Content-Encoding") == "gzip" else None
+    stream = None if high_water is None else RssItemStream(high_water)
+    chunks = []
+    while True:
+        raw = resp.read(FEED_CHUNK_SIZE)
+        if not raw:
+            break
+        chunks.append(decoder.decompress(raw) if decoder else raw)
+        if stream and not stream.failed and stream.feed(chunks[-1]) and stream.stopped:
+            metrics.inc("rss_stream_stopped")
+            return b"".join(chunks), stream.result()
+    if decoder:
+        chunks.append(decoder.flush())
+    return b"".join(chunks), stream.result() if stream else None
+
+def quick_feed_check(store, feed, now):
+    # 不加载aiohttp/feedparser的快速检查，返回 (是否需要完整检查, 已取回的 (body, headers, 增量解析结果) 或 None)
+    import urllib.request
+    import urllib.error
+    due = store.next_pending_check_at()
+    if due is not None and due <= now:
+        return True, None
+    headers = {
+        "User-Agent": USER_AGENT,
+        "Accept": "application/rss+xml, application/xml;q=0.9, */*;q=0.8",
+        "Accept-Encoding": "gzip"
+    }
+    validators = store.feed_validators()
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(feed.url, headers=headers), timeout=30) as resp:
+            body, parsed = read_feed_body(resp, store.feed_high_water() if RSS_INCREMENTAL else None)
+            metrics.observe("rss_fetch", time.perf_counter() - started)
+            metrics.inc("rss_bytes", len(body))
+            return True, (body, resp.headers, parsed)
+    except urllib.error.HTTPError as e:
+        metrics.observe("rss_fetch", time.perf_counter() - started)
+        if e.code == 304:
+            metrics.inc("rss_not_modified")
+            return False, None
+        logging.warning(f"订阅 {feed.name} 快速检查RSS返回{e.code}，改走完整检查")
+    except Exception as e:
+        logging.warning(f"订阅 {feed.name} 快速检查RSS失败：{str(e)}，改走完整检查")
+    return True, None
+
+# ====================== 帖子页解析 =======================
+POST_DIV_CLASS = "message break-all"
+
+def is_audit_page(html):
+    # 等价于在全文上匹配 "本帖正在审核中.*您无权查看"（DOTALL），但不回溯
+    start = html.find("本帖正在审核中")
+    return start != -1 and html.find("您无权查看", start) != -1
+
+class _StopParsing(Exception):
+    pass
+
+_first_post_parser_class = None
+
+def first_post_image_parser():
+    # html.parser 只在解析帖子页时才导入，解析器类首次用到时定义
+    global _first_post_parser_class
+    if _first_post_parser_class is None:
+        from html.parser import HTMLParser
+
+        class FirstPostImageParser(HTMLParser):
+            # 流式扫描：只收集正文div里的img，首帖（isfirst=1）正文闭合后立即停止
+            def __init__(self):
+                super().__init__(convert_charrefs=True)
+                self.div_stack = []
+                self.open_posts = 0
+                self.open_first = 0
+                self.post_found = False
+                self.first_found = False
+                self.first_srcs = []
+                self.all_srcs = []
+
+            def handle_starttag(self, tag, attrs):
+                if tag == "div":
+                    attr_map = dict(attrs)
+                    is_post = " ".join((attr_map.get("class") or "").split()) == POST_DIV_CLASS
+                    is_first = is_post and attr_map.get("isfirst") == "1"
+                    self.div_stack.append((is_post, is_first))
+                    self.open_posts += is_post
+                    self.open_first += is_first
+                    self.post_found = self.post_found or is_post
+                    self.first_found = self.first_found or is_first
+                elif tag == "img" and self.open_posts:
+                    attr_map = dict(attrs)
+                    src = (attr_map.get("data-src") or "").strip() or (attr_map.get("src") or "").strip()
+                    self.all_srcs.append(src)
+                    if self.open_first:
+                        self.first_srcs.append(src)
+
+            def handle_endtag(self, tag):
+                if tag == "div" and self.div_stack:
+                    is_post, is_first = self.div_stack.pop()
+                    self.open_posts -= is_post
+                    self.open_first -= is_first
+                    if is_first and not self.open_first:
+                        raise _StopParsing()
+
+        _first_post_parser_class = FirstPostImageParser
+    return _first_post_parser_class()
+
+def _extract_srcs_stream(html):
+    parser = first_post_image_parser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except _StopParsing:
+        pass
+    if parser.first_found:
+        return parser.first_srcs
+    return parser.all_srcs if parser.post_found else None
+
+def _extract_srcs_selectolax(html):
+    from selectolax.lexbor import LexborHTMLParser
+    tree = LexborHTMLParser(html)
+    # class按空白归一后整体比较，与 stream/bs4 一致（"message  break-all" 也算正文div）
+    posts = [
+        div for div in tree.css("div.message.break-all")
+        if " ".join((div.attributes.get("class") or "").split()) == POST_DIV_CLASS
+    ]
+    first = next((div for div in posts if div.attributes.get("isfirst") == "1"), None)
+    divs = [first] if first is not None else posts
+    if not divs:
         return None
+    srcs = []
+    for div in divs:
+        for img in div.css("img"):
+            srcs.append((img.attributes.get("data-src") or "").strip() or (img.attributes.get("src") or "").strip())
+    return srcs
+
+def _extract_srcs_bs4(html):
+    # 旧版整页建树实现，保留用于对照
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    target_divs = soup.find_all("div", class_=POST_DIV_CLASS, isfirst="1") or soup.find_all("div", class_=POST_DIV_CLASS)
+    if not target_divs:
+        return None
+    return [
+        img.get("data-src", "").strip() or img.get("src", "").strip()
+        for div in target_divs for img in div.find_all("img")
+    ]
+
+PAGE_EXTRACTORS = {
+    "stream": _extract_srcs_stream,
+    "selectolax": _extract_srcs_selectolax,
+    "bs4": _extract_srcs_bs4
+}
+
+def resolve_page_parser(name=PAGE_PARSER):
+    if name == "auto":
+        return "selectolax" if importlib.util.find_spec("selectolax") else "stream"
+    if name not in PAGE_EXTRACTORS:
+        logging.warning(f"未知的PAGE_PARSER={name}，改用stream")
+        return "stream"
+    return name
+
+def normalize_image_urls(srcs, webpage_url):
+    images = []
+    base_domain = "/".join(webpage_url.split("/")[:3])
+    for img_url in srcs:
+        if not img_url or img_url.startswith(("data:image/", "javascript:")):
+            continue
+        if img_url.startswith("/"):
+            img_url = f"{base_domain}{img_url}"
+        elif not img_url.startswith(("http", "https")):
+            img_url = f"{base_domain}/{img_url}"
+        if img_url not in images and img_url.startswith(("http", "https")):
+            images.append(img_url)
+    return images
+
+def parse_post_page(html, webpage_url, parser=None):
+    # 返回 (images, is_pending)；找不到正文div时 images 为 None
+    if is_audit_page(html):
+        return [], True
+    srcs = PAGE_EXTRACTORS[parser or resolve_page_parser()](html)
+    if srcs is None:
+        return None, False
+    return normalize_image_urls(srcs, webpage_url), False
+
+# ====================== 帖子页缓存 =======================
+class PageCache:
+    # 按TID缓存帖子页的ETag/Last-Modified和解析结果；再次抓取时发条件请求，304则直接复用结果
+    def __init__(self, path, ttl_hours, max_entries):
+        self.path = path
+        self.ttl = int(ttl_hours * 3600)
+        self.max_entries = max_entries
+        self.conn = None
+
+    def _open(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    tid INTEGER PRIMARY KEY, url TEXT NOT NULL, etag TEXT, last_modified TEXT,
+                    images TEXT, is_pending INTEGER NOT NULL, validated_at INTEGER NOT NULL
+                )
+            """)
+        return self.conn
+
+    def lookup(self, tid, url):
+        try:
+            row = self._open().execute(
+                "SELECT url, etag, last_modified, images, is_pending, validated_at FROM pages WHERE tid = ?", (tid,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"读取帖子页缓存失败：{str(e)}")
+            return None
+        if not row or row[0] != url or int(time.time()) - row[5] > self.ttl:
+            return None
+        return {"etag": row[1], "last_modified": row[2], "images": json.loads(row[3]) if row[3] else None,
+                "is_pending": bool(row[4])}
+
+    def store(self, tid, url, etag, last_modified, images, is_pending):
+        if not (etag or last_modified):
+            self.forget(tid)
+            return
+        try:
+            self._open().execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (tid, url, etag, last_modified, None if images is None else json.dumps(images),
+                 int(is_pending), int(time.time()))
+            )
+        except sqlite3.Error as e:
+            logging.warning(f"写入帖子页缓存失败：{str(e)}")
+
+    def touch(self, tid):
+        try:
+            self._open().execute("UPDATE pages SET validated_at = ? WHERE tid = ?", (int(time.time()), tid))
+        except sqlite3.Error as e:
+            logging.warning(f"更新帖子页缓存失败：{str(e)}")
+
+    def forget(self, tid):
+        if self.conn is None:
+            return
+        try:
+            self.conn.execute("DELETE FROM pages WHERE tid = ?", (tid,))
+        except sqlite3.Error as e:
+            logging.warning(f"删除帖子页缓存失败：{str(e)}")
+
+    def flush(self):
+        # 运行结束时淘汰过期和超量的条目并提交
+        if self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM pages WHERE validated_at < ?", (int(time.time()) - self.ttl,))
+                self.conn.execute(
+                    "DELETE FROM pages WHERE tid NOT IN (SELECT tid FROM pages ORDER BY validated_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"保存帖子页缓存失败：{str(e)}")
+
+page_cache = PageCache(PAGE_CACHE_FILE, PAGE_CACHE_TTL_HOURS, PAGE_CACHE_MAX_ENTRIES)
 
 # ====================== 帖子信息获取 =======================
-async def get_post_status(session, webpage_url, tid):
+async def get_post_status(http, webpage_url, tid):
     status_code = 200
     try:
         headers = {
-            "User-Agent": USER_AGENT,
             "Referer": FIXED_PROJECT_URL,
             "Accept": "text/html,application/xhtml+xml"
         }
-        async with session.get(webpage_url, headers=headers, timeout=20) as resp:
-            status_code = resp.status
-            if resp.status != 200:
-                logging.warning(f"TID={tid} 帖子请求失败（状态码：{resp.status}）")
-                return [], False, status_code
-            html = await resp.text()
-
-        soup = BeautifulSoup(html, "html.parser")
-        is_pending = False
-
-        audit_h4_tags = soup.find_all("h4", class_=re.compile(r"card-title"))
-        audit_pattern = re.compile(r"本帖正在审核中.*您无权查看", re.DOTALL | re.UNICODE)
-        for h4_tag in audit_h4_tags:
-            if audit_pattern.search(h4_tag.get_text(strip=True)):
-                is_pending = True
-                break
-        if not is_pending and audit_pattern.search(html):
-            is_pending = True
+        cached = page_cache.lookup(tid, webpage_url)
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        metrics.inc("page_requests")
+        with metrics.timer("page_fetch"):
+            async with http.get("forum", webpage_url, headers=headers) as resp:
+                status_code = resp.status
+                if resp.status == 304 and cached:
+                    html = None
+                elif resp.status != 200:
+                    metrics.inc("page_errors")
+                    if resp.status == 404:
+                        page_cache.forget(tid)
+                    logging.warning(f"TID={tid} 帖子请求失败（状态码：{resp.status}）")
+                    return [], False, status_code
+                else:
+                    html = await resp.text()
+                    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
 
+        if html is None:
+            metrics.inc("page_not_modified")
+            page_cache.touch(tid)
+            status_code = 200
+            images, is_pending = cached["images"], cached["is_pending"]
+            logging.debug(f"TID={tid} 帖子页未变化（304），复用缓存的解析结果")
+        else:
+            metrics.inc("page_bytes", len(html))
+            with metrics.timer("page_parse"):
+                images, is_pending = await run_cpu(parse_post_page, html, webpage_url, resolve_page_parser())
+            page_cache.store(tid, webpage_url, etag, last_modified, images, is_pending)
         if is_pending:
             logging.info(f"TID={tid} 确认待审核状态")
             return [], True, status_code
-
-        target_divs = soup.find_all("div", class_="message break-all", isfirst="1") or soup.find_all("div", class_="message break-all")
-        if not target_divs:
+        if images is None:
             logging.warning(f"TID={tid} 未找到正文div，无图片")
             return [], False, status_code
 
-        images = []
-        base_domain = "/".join(webpage_url.split("/")[:3])
-        for div in target_divs:
-            for img in div.find_all("img"):
-                img_url = img.get("data-src", "").strip() or img.get("src", "").strip()
-                if not img_url or img_url.startswith(("data:image/", "javascript:")):
-                    continue
-                if img_url.startswith("/"):
-                    img_url = f"{base_domain}{img_url}"
-                elif not img_url.startswith(("http", "https")):
-                    img_url = f"{base_domain}/{img_url}"
-                if img_url not in images and img_url.startswith(("http", "https")):
-                    images.append(img_url)
-
         final_images = images[:MAX_IMAGES_PER_MSG]
         logging.info(f"TID={tid} 图片提取完成：共{len(images)}张，保留前{len(final_images)}张")
         return final_images, False, status_code
     except Exception as e:
+        metrics.inc("page_errors")
         logging.error(f"TID={tid} 帖子信息获取异常：{str(e)}")
         return [], False, status_code
 
+_host_semaphores = {}
+
+def _host_semaphore(url, pool="page"):
+    host = url.split("/")[2] if "//" in url else url
+    key = (pool, host)
+    if key not in _host_semaphores:
+        limit = IMAGE_FETCH_CONCURRENCY if pool == "image" else PAGE_FETCH_CONCURRENCY
+        _host_semaphores[key] = asyncio.Semaphore(max(1, limit))
+    return _host_semaphores[key]
+
+async def _get_post_status_limited(http, webpage_url, tid):
+    async with _host_semaphore(webpage_url):
+        return await get_post_status(http, webpage_url, tid)
+
+_page_requests = {}
+
+def reset_page_requests():
+    # 每轮开始时清空：同一轮里各订阅共用帖子页结果，下一轮重新抓取
+    _page_requests.clear()
+    _upload_locks.clear()
+
+async def _get_post_status_shared(http, webpage_url, tid):
+    # 多个订阅同一轮抓同一帖子页时只发一次请求，后来者等待同一个结果
+    task = _page_requests.get(webpage_url)
+    if task is None:
+        task = _page_requests[webpage_url] = asyncio.ensure_future(_get_post_status_limited(http, webpage_url, tid))
+    else:
+        metrics.inc("page_shared")
+    return await asyncio.shield(task)
+
+async def fetch_post_statuses(http, targets):
+    # targets: [(webpage_url, tid), ...]，按TID顺序排队抓取，按传入顺序返回 [(images, is_pending, status_code), ...]
+    if not targets:
+        return []
+    order = sorted(range(len(targets)), key=lambda i: targets[i][1])
+    logging.info(f"并发抓取帖子页：共{len(targets)}条，单站点并发上限{PAGE_FETCH_CONCURRENCY}")
+    results = await asyncio.gather(*(_get_post_status_shared(http, *targets[i]) for i in order))
+    statuses = [None] * len(targets)
+    for i, result in zip(order, results):
+        statuses[i] = result
+    return statuses
+
+# ====================== 图片下载/缓存 =======================
+CachedImage = namedtuple("CachedImage", "url path sha256 size content_type")
+
+class ImageCache:
+    # 图片按内容哈希存放（同图多URL只存一份），index.json 记录 URL → 哈希；按访问时间LRU淘汰
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(root, "index.json")
+        self.index = None
+
+    def _load(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, "r", encoding="utf-8") as f:
+                    data = json.loads(f.read().strip() or "{}")
+                self.index = data if isinstance(data, dict) else {}
+        except Exception as e:
+            logging.error(f"读取图片缓存索引失败：{str(e)}")
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def lookup(self, url):
+        self._load()
+        meta = self.index.get(url)
+        if not meta:
+            return None
+        path = self.blob_path(meta["sha256"])
+        try:
+            os.utime(path)
+        except OSError:
+            self.index.pop(url, None)
+            return None
+        return CachedImage(url, path, meta["sha256"], meta["size"], meta["content_type"])
+
+    def temp_path(self):
+        import uuid
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, f"tmp-{uuid.uuid4().hex}")
+
+    def store(self, url, temp_path, sha256, size, content_type):
+        self._load()
+        path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        self.index[url] = {"sha256": sha256, "size": size, "content_type": content_type}
+        return CachedImage(url, path, sha256, size, content_type)
+
+    def flush(self):
+        # 运行结束时淘汰超额的旧图片并保存索引
+        if self.index is None:
+            return
+        try:
+            blobs = []
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if name.startswith("tmp-"):
+                        os.remove(path)
+                    elif len(name) == 64:
+                        st = os.stat(path)
+                        blobs.append((st.st_mtime, st.st_size, name, path))
+            total = sum(b[1] for b in blobs)
+            removed = set()
+            for _, size, name, path in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                removed.add(name)
+                total -= size
+            existing = {b[2] for b in blobs} - removed
+            self.index = {u: m for u, m in self.index.items() if m.get("sha256") in existing}
+            os.makedirs(self.root, exist_ok=True)
+            temp_file = f"{self.index_file}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(self.index, f, ensure_ascii=False)
+            os.replace(temp_file, self.index_file)
+            logging.info(f"图片缓存：{len(existing)}张，共{total / 1024 / 1024:.1f}MB，本次淘汰{len(removed)}张")
+        except Exception as e:
+            logging.error(f"整理图片缓存失败：{str(e)}")
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+class FileIdCache:
+    # 已上传图片的 内容哈希 → file_id，所有订阅和频道共用，同一张图只上传一次；按最近使用时间淘汰
+    def __init__(self, path, ttl_days, max_entries):
+        self.path = path
+        self.ttl = int(ttl_days * 86400)
+        self.max_entries = max_entries
+        self.conn = None
+
+    def _open(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_files (sha256 TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated_at INTEGER NOT NULL)"
+            )
+        return self.conn
+
+    def get(self, sha256):
+        try:
+            conn = self._open()
+            row = conn.execute("SELECT file_id FROM media_files WHERE sha256 = ?", (sha256,)).fetchone()
+            if row:
+                conn.execute("UPDATE media_files SET updated_at = ? WHERE sha256 = ?", (int(time.time()), sha256))
+        except sqlite3.Error as e:
+            logging.warning(f"读取file_id缓存失败：{str(e)}")
+            return None
+        return row[0] if row else None
+
+    def remember(self, sha256, file_id):
+        try:
+            self._open().execute(
+                "INSERT OR REPLACE INTO media_files VALUES (?, ?, ?)", (sha256, file_id, int(time.time()))
+            )
+        except sqlite3.Error as e:
+            logging.warning(f"写入file_id缓存失败：{str(e)}")
+
+    def forget(self, sha256):
+        try:
+            self._open().execute("DELETE FROM media_files WHERE sha256 = ?", (sha256,))
+        except sqlite3.Error as e:
+            logging.warning(f"删除file_id缓存失败：{str(e)}")
+
+    def flush(self):
+        # 运行结束时淘汰过期和超量的条目并提交
+        if self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM media_files WHERE updated_at < ?", (int(time.time()) - self.ttl,))
+                self.conn.execute(
+                    "DELETE FROM media_files WHERE sha256 NOT IN "
+                    "(SELECT sha256 FROM media_files ORDER BY updated_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"保存file_id缓存失败：{str(e)}")
+
+file_id_cache = FileIdCache(MEDIA_CACHE_FILE, MEDIA_FILE_ID_TTL_DAYS, MEDIA_FILE_ID_MAX_ROWS)
+
+async def download_image(http, image_url, tid):
+    import hashlib
+    cached = image_cache.lookup(image_url)
+    if cached:
+        metrics.inc("image_cache_hits")
+        logging.debug(f"TID={tid} 图片命中缓存：{image_url}")
+        return cached
+    temp_path = None
+    try:
+        async with _host_semaphore(image_url, "image"):
+            metrics.inc("image_downloads")
+            started = time.perf_counter()
+            async with http.get("images", image_url) as resp:
+                if resp.status != 200:
+                    logging.warning(f"TID={tid} 图片请求失败（状态码：{resp.status}）：{image_url}")
+                    return None
+                # 先只读文件头校验格式，不合格直接断开，不再下载整张图
+                head = b""
+                while len(head) < IMAGE_SNIFF_BYTES:
+                    chunk = await resp.content.read(IMAGE_SNIFF_BYTES - len(head))
+                    if not chunk:
+                        break
+                    head += chunk
+                if not is_valid_image(head):
+                    return None
+                content_type = resp.headers.get("Content-Type") or get_image_content_type(image_url)
+                digest = hashlib.sha256(head)
+                size = len(head)
+                temp_path = image_cache.temp_path()
+                with open(temp_path, "wb") as f:
+                    f.write(head)
+                    async for chunk in resp.content.iter_chunked(IMAGE_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            metrics.observe("image_download", time.perf_counter() - started)
+            metrics.inc("image_bytes", size)
+        image = image_cache.store(image_url, temp_path, digest.hexdigest(), size, content_type)
+        temp_path = None
+        return image
+    except Exception as e:
+        metrics.inc("image_errors")
+        logging.error(f"TID={tid} 图片下载异常：{str(e) or type(e).__name__}")
+        return None
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+async def download_images(http, image_urls, tid):
+    # 并发下载，按原顺序返回；任意一张失败立即取消其余下载并返回None
+    tasks = [asyncio.ensure_future(download_image(http, url, tid)) for url in image_urls]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            if await fut is None:
+                return None
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+
 # ====================== Markdown转义/消息构造 =======================
 def escape_markdown(text):
     special_chars = r"_*~`>#+!()"
@@ -244,10 +1431,7 @@ def escape_markdown(text):
             text = text.replace(char, f"\{char}")
     return text
 
-def build_caption(title, author, description, link):
-    if len(description) > MAX_DESCRIPTION_LENGTH:
-        description = description[:MAX_DESCRIPTION_LENGTH] + "..."
-    footer = """
+CAPTION_FOOTER = """
 ✅论坛最新地址: 
 tyw29.cc  tyw30.cc tyw33.cc
 ✅点击加入交流群: https://www.sfw.vc/tyw666
@@ -255,163 +1439,487 @@ tyw29.cc  tyw30.cc tyw33.cc
 沈复： @tywcc
 沐泽： @ssss001
 怡怡： @yiyi3
-    """.strip()
+""".strip()
+
+def build_caption(title, author, description, link):
+    if len(description) > MAX_DESCRIPTION_LENGTH:
+        description = description[:MAX_DESCRIPTION_LENGTH] + "..."
     return (
         f"{escape_markdown(title)}\n"
         f"由 ＠{escape_markdown(author)} 发起的话题讨论\n"
         f"{escape_markdown(description)}\n"  
         f"链接：{link}\n\n"
-        f"{footer}"
+        f"{CAPTION_FOOTER}"
     )
 
+def build_digest_block(entry):
+    return (
+        f"{escape_markdown(entry['rss_title'])}\n"
+        f"由 ＠{escape_markdown(entry['rss_author'])} 发起的话题讨论\n"
+        f"链接：{entry['link']}"
+    )
+
+def build_digest(entries):
+    return "\n\n".join(build_digest_block(e) for e in entries) + f"\n\n{CAPTION_FOOTER}"
+
+# ====================== 发送限速/重试 ========================
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        # 收到429后retry_after内不再发送，到期只放行一次重试
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 1
+        self.updated = self.blocked_until
+
+class SendUnconfirmed(Exception):
+    # 请求已发出但没拿到结果（超时/连接中断/重试耗尽的5xx），消息可能已送达，不能当作失败重发
+    pass
+
+class SendScheduler:
+    def __init__(self, rate_per_min, burst, max_retries):
+        self.rate = max(rate_per_min, 0.1) / 60
+        self.burst = max(1, burst)
+        self.max_retries = max(0, max_retries)
+        self.buckets = {}
+
+    def bucket(self, chat_id):
+        key = str(chat_id)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return self.buckets[key]
+
+    def backoff(self, attempt):
+        import random
+        delay = min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    async def call(self, http, method, tid, make_request, chat_id=None, journal=None):
+        # make_request() 每次重试都重新构造请求参数（data/json/headers）
+        # journal(True) 在每次POST前记下发送意图，确定未送达（连接失败/4xx）时调用 journal(False)；
+        # 结果未知（请求发出后超时/断开、带journal时的5xx）时抛出 SendUnconfirmed，不再重试，避免重复推送
+        import random
+        import aiohttp
+        not_sent_errors = (aiohttp.ClientConnectorError,) + (
+            (aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, "ConnectionTimeoutError") else ()
+        )
+        chat_id = SAFEW_CHAT_ID if chat_id is None else chat_id
+        bucket = self.bucket(chat_id)
+        api_url = f"{SAFEW_API_BASE}/bot{SAFEW_BOT_TOKEN}/{method}"
+        for attempt in range(self.max_retries + 1):
+            with metrics.timer("api_rate_wait"):
+                await bucket.acquire()
+            wait = None
+            request = make_request()
+            if journal:
+                journal(True)
+            metrics.inc("api_requests")
+            started = time.perf_counter()
+            try:
+                async with http.post("api", api_url, **request) as resp:
+                    text = await resp.text()
+                    metrics.observe("api_send", time.perf_counter() - started)
+                    if resp.status == 200:
+                        try:
+                            return json.loads(text)
+                        except ValueError:
+                            return {"ok": True}
+                    if journal and resp.status >= 500:
+                        metrics.inc("api_server_errors")
+                        metrics.inc("api_unconfirmed")
+                        logging.error(f"TID={tid} ❌ {method} 服务端错误（{resp.status}），无法确认是否送达，不再重试")
+                        raise SendUnconfirmed(f"{method} 服务端错误（{resp.status}）")
+                    if journal:
+                        journal(False)
+                    if resp.status == 429:
+                        metrics.inc("api_rate_limited")
+                        wait = parse_retry_after(text, resp.headers)
+                        bucket.block(wait)
+                        wait += random.uniform(0, 1)
+                        logging.warning(f"TID={tid} {method} 触发限流（429），{wait:.1f}秒后重试")
+                    elif resp.status >= 500:
+                        metrics.inc("api_server_errors")
+                        wait = self.backoff(attempt)
+                        logging.warning(f"TID={tid} {method} 服务端错误（{resp.status}），{wait:.1f}秒后重试")
+                    else:
+                        metrics.inc("api_errors")
+                        logging.error(f"TID={tid} ❌ {method} 失败（{resp.status}）：{text[:200]}")
+                        return None
+            except not_sent_errors as e:
+                metrics.inc("api_connect_errors")
+                # 只重试连接阶段的失败；请求已发出后的超时可能已送达，重试会重复推送
+                if journal:
+                    journal(False)
+                wait = self.backoff(attempt)
+                logging.warning(f"TID={tid} {method} 连接失败：{str(e) or type(e).__name__}，{wait:.1f}秒后重试")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc("api_unconfirmed")
+                logging.error(f"TID={tid} ❌ {method} 请求已发出但未收到结果：{str(e) or type(e).__name__}")
+                raise SendUnconfirmed(f"{method} {str(e) or type(e).__name__}") from e
+            if attempt < self.max_retries:
+                await asyncio.sleep(wait)
+        logging.error(f"TID={tid} ❌ {method} 重试{self.max_retries}次仍失败")
+        return None
+
+def parse_retry_after(text, headers):
+    try:
+        retry_after = json.loads(text).get("parameters", {}).get("retry_after")
+        if retry_after is not None:
+            return max(0.0, float(retry_after))
+    except (ValueError, AttributeError):
+        pass
+    try:
+        return max(0.0, float(headers.get("Retry-After", "")))
+    except ValueError:
+        return SEND_BACKOFF_BASE
+
+send_scheduler = SendScheduler(SEND_RATE_PER_MIN, SEND_BURST, SEND_MAX_RETRIES)
+
+# ====================== multipart流式上传 ========================
+class MultipartStream:
+    # 按part顺序边读边发：文件部分直接从缓存文件分块读取，内存里最多一个分块
+    def __init__(self):
+        import uuid
+        self.boundary = f"----WebKitFormBoundary{uuid.uuid4().hex[:16]}"
+        self.parts = []
+
+    def _header(self, disposition, content_type=None):
+        lines = [f"--{self.boundary}", f"Content-Disposition: form-data; {disposition}"]
+        if content_type:
+            lines.append(f"Content-Type: {content_type}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+    def add_field(self, name, value, content_type=None):
+        data = value if isinstance(value, bytes) else str(value).encode("utf-8")
+        self.parts.append((self._header(f'name="{name}"', content_type), data, None, len(data)))
+
+    def add_file(self, name, filename, path, content_type, size):
+        header = self._header(f'name="{name}"; filename="{filename}"', content_type)
+        self.parts.append((header, None, path, size))
+
+    @property
+    def closing(self):
+        return f"--{self.boundary}--\r\n".encode("utf-8")
+
+    @property
+    def size(self):
+        return sum(len(header) + size + 2 for header, _, _, size in self.parts) + len(self.closing)
+
+    async def iter_chunks(self):
+        for header, data, path, _ in self.parts:
+            yield header
+            if path is None:
+                yield data
+            else:
+                with open(path, "rb") as f:
+                    while True:
+                        chunk = f.read(IMAGE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+            yield b"\r\n"
+        yield self.closing
+
+    def request(self):
+        # 每次调用都生成新的body迭代器，可直接作为 SendScheduler.call 的 make_request
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={self.boundary}",
+            "Content-Length": str(self.size)
+        }
+        return {"data": self.iter_chunks(), "headers": headers}
+
+def apply_upload_budget(images, tid):
+    # 按单条消息的字节预算从尾部裁剪图片，至少保留第一张
+    # 复用file_id的图片也按原大小计入，保证同一帖子发往各频道的图片组一致
+    if MAX_UPLOAD_BYTES_PER_MSG <= 0:
+        return images
+    total = 0
+    for idx, image in enumerate(images):
+        total += image.size
+        if total > MAX_UPLOAD_BYTES_PER_MSG and idx > 0:
+            logging.warning(f"TID={tid} 超出单条预算{MAX_UPLOAD_BYTES_PER_MSG}字节，仅发送前{idx}张")
+            return images[:idx]
+    return images
+
 # ====================== 消息发送函数 ========================
-async def send_single_photo(session, image_url, caption, tid, delay=5):
+def extract_file_ids(result):
+    # sendPhoto 返回单条Message，sendMediaGroup 返回Message数组；每条取最大尺寸的file_id
+    messages = result.get("result") if isinstance(result, dict) else None
+    if isinstance(messages, dict):
+        messages = [messages]
+    file_ids = []
+    for message in messages or []:
+        photos = message.get("photo") if isinstance(message, dict) else None
+        file_ids.append(photos[-1].get("file_id") if photos else None)
+    return file_ids
+
+def remember_file_ids(images, result):
+    file_ids = extract_file_ids(result)
+    for image, file_id in zip(images, file_ids):
+        if file_id:
+            file_id_cache.remember(image.sha256, file_id)
+
+async def send_single_photo(http, image_url, caption, tid, chat_id=None, journal=None):
+    chat_id = SAFEW_CHAT_ID if chat_id is None else chat_id
     try:
-        await asyncio.sleep(delay)
-        api_url = f"https://api.safew.org/bot{SAFEW_BOT_TOKEN}/sendPhoto"
-        async with session.get(image_url, headers={"User-Agent": USER_AGENT}, timeout=15) as resp:
-            img_data = await resp.read()
-            if not is_valid_image(img_data):
-                return False
-            content_type = resp.headers.get("Content-Type") or get_image_content_type(image_url)
-        boundary = f"----WebKitFormBoundary{uuid.uuid4().hex[:16]}"
-        filename = f"single_{tid}_{uuid.uuid4().hex[:8]}.jpg"
-        body = b"\r\n".join([
-            f"--{boundary}".encode("utf-8"),
-            b'Content-Disposition: form-data; name="chat_id"',
-            b'',
-            str(SAFEW_CHAT_ID).encode("utf-8"),
-            f"--{boundary}".encode("utf-8"),
-            b'Content-Disposition: form-data; name="caption"',
-            b'',
-            caption.encode("utf-8"),
-            f"--{boundary}".encode("utf-8"),
-            f'Content-Disposition: form-data; name="photo"; filename="{filename}"'.encode("utf-8"),
-            f"Content-Type: {content_type}".encode("utf-8"),
-            b'',
-            img_data,
-            f"--{boundary}--".encode("utf-8")
-        ])
-        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
-        async with session.post(api_url, data=body, headers=headers, timeout=30) as resp:
-            if resp.status == 200:
-                logging.info(f"TID={tid} ✅ 单图消息发送成功")
-                return True
-            logging.error(f"TID={tid} ❌ 单图失败：{await resp.text()[:200]}")
-            return False
+        images = await download_images(http, [image_url], tid)
+        if not images:
+            return None
+        image = images[0]
+        file_id = file_id_cache.get(image.sha256)
+        if file_id:
+            payload = {"chat_id": chat_id, "photo": file_id, "caption": caption}
+            result = await send_scheduler.call(http, "sendPhoto", tid, lambda: {"json": payload}, chat_id, journal)
+            if result is not None:
+                logging.info(f"TID={tid} ✅ 单图消息发送成功（复用file_id）")
+                return result
+            logging.warning(f"TID={tid} file_id发送失败，改为重新上传")
+            file_id_cache.forget(image.sha256)
+
+        import uuid
+        with metrics.timer("multipart_build"):
+            form = MultipartStream()
+            form.add_field("chat_id", chat_id)
+            form.add_field("caption", caption)
+            form.add_file("photo", f"single_{tid}_{uuid.uuid4().hex[:8]}.jpg", image.path, image.content_type, image.size)
+            metrics.inc("upload_bytes", form.size)
+        result = await send_scheduler.call(http, "sendPhoto", tid, lambda: form.request(), chat_id, journal)
+        if result is not None:
+            remember_file_ids(images, result)
+            logging.info(f"TID={tid} ✅ 单图消息发送成功")
+            return result
+        logging.error(f"TID={tid} ❌ 单图失败")
+        return None
+    except SendUnconfirmed:
+        raise
     except Exception as e:
         logging.error(f"TID={tid} 单图发送异常：{str(e)}")
-        return False
+        return None
+
+def build_media_group_request(images, file_ids, caption, tid, chat_id):
+    with metrics.timer("multipart_build"):
+        return _build_media_group_request(images, file_ids, caption, tid, chat_id)
+
+def _build_media_group_request(images, file_ids, caption, tid, chat_id):
+    # 已有file_id的图片直接引用，其余以 attach:// 方式随multipart上传；全部有file_id时走JSON
+    import uuid
+    media_array = []
+    uploads = []
+    for idx, (image, file_id) in enumerate(zip(images, file_ids), 1):
+        if file_id:
+            media = file_id
+        else:
+            filename = f"media_{tid}_{idx}_{uuid.uuid4().hex[:8]}.jpg"
+            uploads.append((image, filename))
+            media = f"attach://{filename}"
+        item = {"type": "photo", "media": media, "parse_mode": "Markdown"}
+        if idx == 1:
+            item["caption"] = caption
+        media_array.append(item)
+
+    if not uploads:
+        payload = {"chat_id": chat_id, "media": media_array}
+        return lambda: {"json": payload}
 
-async def send_media_group(session, image_urls, caption, tid, delay=5):
+    form = MultipartStream()
+    form.add_field("chat_id", chat_id)
+    form.add_field("media", json.dumps(media_array, ensure_ascii=False), "application/json")
+    for image, fn in uploads:
+        form.add_file(fn, fn, image.path, image.content_type, image.size)
+    metrics.inc("upload_bytes", form.size)
+    return lambda: form.request()
+
+async def send_media_group(http, image_urls, caption, tid, chat_id=None, journal=None):
+    chat_id = SAFEW_CHAT_ID if chat_id is None else chat_id
     if len(image_urls) < 2 or len(image_urls) > MAX_IMAGES_PER_MSG:
-        return False
+        return None
     try:
-        await asyncio.sleep(delay)
-        api_url = f"https://api.safew.org/bot{SAFEW_BOT_TOKEN}/sendMediaGroup"
-        media_data = []
-        for idx, img_url in enumerate(image_urls, 1):
-            filename = f"media_{tid}_{idx}_{uuid.uuid4().hex[:8]}.jpg"
-            async with session.get(img_url, headers={"User-Agent": USER_AGENT}, timeout=15) as resp:
-                img_data = await resp.read()
-                if not is_valid_image(img_data):
-                    return False
-                content_type = resp.headers.get("Content-Type") or get_image_content_type(img_url)
-            media_data.append((img_data, content_type, filename))
-        
-        media_array = []
-        for idx, (_, ct, fn) in enumerate(media_data):
-            item = {"type": "photo", "media": f"attach://{fn}", "parse_mode": "Markdown"}
-            if idx == 0:
-                item["caption"] = caption
-            media_array.append(item)
-        
-        boundary = f"----WebKitFormBoundary{uuid.uuid4().hex[:16]}"
-        body_parts = [
-            f"--{boundary}".encode("utf-8"),
-            b'Content-Disposition: form-data; name="chat_id"',
-            b'',
-            str(SAFEW_CHAT_ID).encode("utf-8"),
-            f"--{boundary}".encode("utf-8"),
-            b'Content-Disposition: form-data; name="media"',
-            b'Content-Type: application/json',
-            b'',
-            json.dumps(media_array, ensure_ascii=False).encode("utf-8")
-        ]
-        for img_data, ct, fn in media_data:
-            body_parts.extend([
-                f"--{boundary}".encode("utf-8"),
-                f'Content-Disposition: form-data; name="{fn}"; filename="{fn}"'.encode("utf-8"),
-                f"Content-Type: {ct}".encode("utf-8"),
-                b'',
-                img_data
-            ])
-        body_parts.append(f"--{boundary}--".encode("utf-8"))
-        body = b"\r\n".join(body_parts)
-        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
-        async with session.post(api_url, data=body, headers=headers, timeout=30) as resp:
-            if resp.status == 200:
-                logging.info(f"TID={tid} ✅ 多图消息发送成功")
-                return True
-            logging.error(f"TID={tid} ❌ 多图失败：{await resp.text()[:200]}")
-            return False
+        images = await download_images(http, image_urls, tid)
+        if not images:
+            return None
+        images = apply_upload_budget(images, tid)
+        if len(images) == 1:
+            return await send_single_photo(http, images[0].url, caption, tid, chat_id, journal)
+        file_ids = [file_id_cache.get(image.sha256) for image in images]
+        reused = sum(1 for f in file_ids if f)
+        make_request = build_media_group_request(images, file_ids, caption, tid, chat_id)
+        result = await send_scheduler.call(http, "sendMediaGroup", tid, make_request, chat_id, journal)
+        if result is None and reused:
+            logging.warning(f"TID={tid} 复用file_id发送失败，改为全部重新上传")
+            for image, file_id in zip(images, file_ids):
+                if file_id:
+                    file_id_cache.forget(image.sha256)
+            reused = 0
+            make_request = build_media_group_request(images, [None] * len(images), caption, tid, chat_id)
+            result = await send_scheduler.call(http, "sendMediaGroup", tid, make_request, chat_id, journal)
+        if result is not None:
+            remember_file_ids(images, result)
+            logging.info(f"TID={tid} ✅ 多图消息发送成功（复用file_id {reused}/{len(images)}张）")
+            return result
+        logging.error(f"TID={tid} ❌ 多图失败")
+        return None
+    except SendUnconfirmed:
+        raise
     except Exception as e:
         logging.error(f"TID={tid} 多图发送异常：{str(e)}")
-        return False
+        return None
 
-async def send_text_msg(session, caption, tid, delay=5):
+async def send_text_msg(http, caption, tid, chat_id=None, journal=None):
     try:
-        await asyncio.sleep(delay)
-        api_url = f"https://api.safew.org/bot{SAFEW_BOT_TOKEN}/sendMessage"
         payload = {
-            "chat_id": SAFEW_CHAT_ID,
+            "chat_id": SAFEW_CHAT_ID if chat_id is None else chat_id,
             "text": caption,
             "parse_mode": "Markdown",
             "disable_web_page_preview": True
         }
-        async with session.post(api_url, json=payload, timeout=15) as resp:
-            if resp.status == 200:
-                logging.info(f"TID={tid} ✅ 纯文本发送成功")
-                return True
-            logging.error(f"TID={tid} ❌ 文本失败：{await resp.text()[:200]}")
-            return False
+        result = await send_scheduler.call(
+            http, "sendMessage", tid, lambda: {"json": payload}, payload["chat_id"], journal
+        )
+        if result is not None:
+            logging.info(f"TID={tid} ✅ 纯文本发送成功")
+            return result
+        logging.error(f"TID={tid} ❌ 文本失败")
+        return None
+    except SendUnconfirmed:
+        raise
     except Exception as e:
         logging.error(f"TID={tid} 文本发送异常：{str(e)}")
-        return False
+        return None
+
+def extract_message_ids(result):
+    messages = result.get("result") if isinstance(result, dict) else None
+    if isinstance(messages, dict):
+        messages = [messages]
+    return [m.get("message_id") for m in messages or [] if isinstance(m, dict)]
+
+async def send_post(http, chat_id, images, caption, tid, journal=None):
+    # 成功时返回API结果，确定失败返回None，结果未知时抛出 SendUnconfirmed；图片下载和请求构造都在journal记录之前完成
+    if len(images) == 1:
+        return await send_single_photo(http, images[0], caption, tid, chat_id, journal)
+    if 2 <= len(images) <= MAX_IMAGES_PER_MSG:
+        return await send_media_group(http, images, caption, tid, chat_id, journal)
+    return await send_text_msg(http, caption, tid, chat_id, journal)
+
+_upload_locks = {}
+
+def _upload_lock(images):
+    key = tuple(images)
+    if key not in _upload_locks:
+        _upload_locks[key] = asyncio.Lock()
+    return _upload_locks[key]
+
+async def fan_out(http, store, chats, tids, images, caption, label):
+    # 同一条消息发往订阅的所有频道：有图时先发第一个频道完成上传，其余频道复用file_id并发发送
+    # tids 为这条消息覆盖的TID（合并摘要时有多个）；返回是否所有频道都已送达
+    # 每次POST前在outbox记下意图，发送结果（含message_id）立即落盘，中途被杀也不会重发已送达的消息
+    remaining = [c for c in chats if any(c not in store.delivered_chats(t) for t in tids)]
+
+    async def send_one(chat_id):
+        try:
+            result = await send_post(http, chat_id, images, caption, label, store.outbox_journal(tids, chat_id))
+        except SendUnconfirmed:
+            result = None
+        if result is not None:
+            store.outbox_done(tids, chat_id, extract_message_ids(result))
+            return True
+        if not store.outbox_in_flight(tids, chat_id):
+            return False
+        # 请求已发出但结果未知
+        if OUTBOX_RESEND_UNCONFIRMED:
+            store.outbox_abort(tids, chat_id)
+            logging.warning(f"TID={label} 发送到{chat_id}结果未知，下次重新发送")
+            return False
+        store.outbox_unconfirmed(tids, chat_id)
+        logging.warning(f"TID={label} 发送到{chat_id}结果未知，按已送达处理不再重发")
+        return True
+
+    rest = remaining
+    results = []
+    if images and remaining:
+        # 多个订阅同时推送同一帖子时，等先到的那次上传完成后直接复用file_id
+        async with _upload_lock(images):
+            results.append(await send_one(remaining[0]))
+        rest = remaining[1:]
+    results += await asyncio.gather(*(send_one(c) for c in rest))
+    succeeded = [c for c, ok in zip(remaining, results) if ok]
+    if len(succeeded) == len(remaining):
+        return True
+    if len(chats) > 1:
+        logging.warning(f"TID={label} 仅送达{len(chats) - len(remaining) + len(succeeded)}/{len(chats)}个频道，其余下次重试")
+    return False
 
 # ====================== 待审核数据检查 =======================
-async def check_pending_data(session):
-    pending_data = load_pending_data()
-    if not pending_data:
+async def check_pending_data(http, store, feed):
+    if not store.pending:
         logging.info("无待审核数据，跳过检查")
         return
 
-    logging.info(f"\n=== 开始检查待审核数据（共{len(pending_data)}条 → {[d['tid'] for d in pending_data]}）===")
-    sent_tids = load_sent_tids()
+    now = int(time.time())
+    pending_data = []
+    expired_tids = []
+    for item in store.due_pending(now):
+        if PENDING_MAX_AGE_HOURS > 0 and now - item["first_seen"] > PENDING_MAX_AGE_HOURS * 3600:
+            expired_tids.append(item["tid"])
+            store.remove_pending(item["tid"])
+            logging.warning(f"TID={item['tid']} 待审核超过{PENDING_MAX_AGE_HOURS}小时，放弃跟踪")
+        else:
+            pending_data.append(item)
+    if not pending_data:
+        store.commit()
+        logging.info(f"待审核共{len(store.pending)}条，暂无到期需复查的帖子")
+        return
+
+    logging.info(f"\n=== 开始检查待审核数据（到期{len(pending_data)}条/共{len(store.pending)}条）===")
     passed_tids = []
     still_pending = []
     deleted_tids = []
 
-    for item in pending_data:
+    links = [f"{feed.forum_url}thread-{item['tid']}.htm" for item in pending_data]
+    statuses = await fetch_post_statuses(http, list(zip(links, [d["tid"] for d in pending_data])))
+
+    for item, link, (images, is_pending, status_code) in zip(pending_data, links, statuses):
         tid = item["tid"]
-        link = f"{FIXED_PROJECT_URL}thread-{tid}.htm"
         logging.info(f"检查TID={tid} 审核状态：{link[:50]}...")
-        
-        images, is_pending, status_code = await get_post_status(session, link, tid)
 
         if status_code == 404:
             deleted_tids.append(tid)
+            store.remove_pending(tid)
             logging.warning(f"TID={tid} 帖子已删除（404），从待审核移除")
             continue
 
         if status_code != 200:
             still_pending.append(item)
+            store.reschedule_pending(tid, backoff=False)
             logging.warning(f"TID={tid} 请求异常（{status_code}），保留待审核")
             continue
 
         if is_pending:
             still_pending.append(item)
-            logging.info(f"TID={tid} 仍待审核，保留")
+            next_check_at = store.reschedule_pending(tid)
+            logging.info(f"TID={tid} 仍待审核（第{item['attempts'] + 1}次），{next_check_at - now}秒后复查")
             continue
 
         caption = build_caption(
@@ -421,51 +1929,61 @@ async def check_pending_data(session):
             link=link
         )
         
-        success = False
-        if len(images) == 1:
-            success = await send_single_photo(session, images[0], caption, tid, delay=3)
-        elif 2 <= len(images) <= MAX_IMAGES_PER_MSG:
-            success = await send_media_group(session, images, caption, tid, delay=3)
-        else:
-            success = await send_text_msg(session, caption, tid, delay=3)
-
+        success = await fan_out(http, store, feed.chats, [tid], images, caption, tid)
         if success:
             passed_tids.append(tid)
-            sent_tids.append(tid)
+            store.mark_sent(tid)
             logging.info(f"TID={tid} 审核通过推送成功（标题：{item['title'][:20]}...）")
         else:
             still_pending.append(item)
+            store.reschedule_pending(tid, backoff=False)
             logging.warning(f"TID={tid} 推送失败，保留待重试")
 
-    save_pending_data(still_pending)
-    if passed_tids:
-        save_sent_tids(passed_tids, sent_tids)
-    logging.info(f"待审核检查完成：{len(passed_tids)}条通过，{len(still_pending)}条待审，{len(deleted_tids)}条删除")
+    store.commit()
+    logging.info(
+        f"待审核检查完成：{len(passed_tids)}条通过，{len(still_pending)}条待审，{len(deleted_tids)}条删除，"
+        f"{len(expired_tids)}条超时放弃"
+    )
 
 # ====================== 全新帖子推送 =======================
-async def push_new_posts(session, new_entries):
+def take_digest_group(ready, start):
+    # 从start起取连续的纯文本帖，受条数和消息长度限制
+    group = []
+    length = len(CAPTION_FOOTER)
+    for entry, images in ready[start:]:
+        if images or len(group) >= DIGEST_MAX_POSTS:
+            break
+        block = len(build_digest_block(entry)) + 2
+        if group and length + block > DIGEST_MAX_CHARS:
+            break
+        group.append(entry)
+        length += block
+    return group
+
+async def push_new_posts(http, store, feed, new_entries, drain=False, deadline=None):
+    # 返回本次已处理完毕（推送成功/转入待审核/已删除）的TID
+    # drain=True 时预取全部帖子的图片，连续纯文本帖可合并为一条摘要；deadline（loop.time()）到点后停止发送
     if not new_entries:
         logging.info("无全新帖子待推送")
-        return
+        return []
 
     logging.info(f"\n=== 开始推送全新帖子（共{len(new_entries)}条）===")
-    sent_tids = load_sent_tids()
-    pending_data = load_pending_data()
     success_pushed = []
+    resolved_tids = []
+    ready = []
+    new_entries = sorted(new_entries, key=lambda x: x["tid"])
+    statuses = await fetch_post_statuses(http, [(e["link"], e["tid"]) for e in new_entries])
 
-    for i, entry in enumerate(new_entries):
+    for entry, (images, is_pending, status_code) in zip(new_entries, statuses):
         tid = entry["tid"]
-        link = entry["link"]
-        delay = 5 if i > 0 else 0
 
         rss_title = entry["rss_title"]
         rss_author = entry["rss_author"]
         rss_description = entry["rss_description"]
         logging.debug(f"TID={tid} RSS信息：标题={rss_title[:20]}，作者={rss_author}，描述={rss_description[:30]}...")
 
-        images, is_pending, status_code = await get_post_status(session, link, tid)
-        
         if status_code == 404:
+            resolved_tids.append(tid)
             logging.warning(f"TID={tid} 帖子已删除（404），跳过")
             continue
         
@@ -474,66 +1992,266 @@ async def push_new_posts(session, new_entries):
             continue
 
         if is_pending:
-            pending_data.append({
+            store.add_pending({
                 "tid": tid,
                 "title": rss_title,
                 "author": rss_author,
                 "description": rss_description
             })
-            save_pending_data(pending_data)
+            resolved_tids.append(tid)
             logging.info(f"TID={tid} 新增待审核（标题：{rss_title[:20]}... 作者：{rss_author}）")
             continue
 
-        caption = build_caption(
-            title=rss_title,
-            author=rss_author,
-            description=rss_description,
-            link=link
-        )
-        
-        success = False
-        if len(images) == 1:
-            success = await send_single_photo(session, images[0], caption, tid, delay)
-        elif 2 <= len(images) <= MAX_IMAGES_PER_MSG:
-            success = await send_media_group(session, images, caption, tid, delay)
-        else:
-            success = await send_text_msg(session, caption, tid, delay)
+        ready.append((entry, images))
 
-        if success:
-            success_pushed.append(tid)
-            sent_tids.append(tid)
-            logging.info(f"TID={tid} 全新帖子推送成功（作者：{rss_author}）")
+    prefetch = {}
+    if drain:
+        # 整批图片并发预取进缓存，发送时按TID顺序直接命中
+        for entry, images in ready:
+            if images:
+                prefetch[entry["tid"]] = asyncio.ensure_future(download_images(http, images, entry["tid"]))
+        logging.info(f"积压模式：待发送{len(ready)}条，预取{len(prefetch)}条帖子的图片")
 
-    if success_pushed:
-        save_sent_tids(success_pushed, sent_tids)
-    else:
+    loop = asyncio.get_running_loop()
+    try:
+        i = 0
+        while i < len(ready):
+            if deadline is not None and loop.time() >= deadline:
+                logging.warning(f"本轮时间预算已用完，剩余{len(ready) - i}条留到下次推送")
+                break
+            entry, images = ready[i]
+            tid = entry["tid"]
+
+            group = take_digest_group(ready, i) if drain and DRAIN_DIGEST else []
+            if len(group) > 1:
+                label = f"{group[0]['tid']}~{group[-1]['tid']}"
+                if await fan_out(http, store, feed.chats, [item["tid"] for item in group], [], build_digest(group), label):
+                    for item in group:
+                        success_pushed.append(item["tid"])
+                        resolved_tids.append(item["tid"])
+                        store.mark_sent(item["tid"])
+                    logging.info(f"TID={label} 合并摘要推送成功（{len(group)}条）")
+                i += len(group)
+                continue
+
+            if tid in prefetch:
+                await prefetch[tid]
+            caption = build_caption(
+                title=entry["rss_title"],
+                author=entry["rss_author"],
+                description=entry["rss_description"],
+                link=entry["link"]
+            )
+            
+            if await fan_out(http, store, feed.chats, [tid], images, caption, tid):
+                success_pushed.append(tid)
+                resolved_tids.append(tid)
+                store.mark_sent(tid)
+                logging.info(f"TID={tid} 全新帖子推送成功（作者：{entry['rss_author']}）")
+            i += 1
+    finally:
+        for task in prefetch.values():
+            task.cancel()
+
+    store.commit()
+    if not success_pushed:
         logging.info("无全新帖子推送成功")
+    return resolved_tids
+
+# ====================== 订阅配置 =======================
+Feed = namedtuple("Feed", "name url chats forum_url state_file")
+
+def feed_state_file(name):
+    # default 订阅沿用原来的 state.db，便于从单订阅平滑切换
+    if name == "default":
+        return STATE_DB_FILE
+    return os.path.join(os.path.dirname(STATE_DB_FILE), f"state_{name}.db")
+
+def load_feeds(path=FEEDS_CONFIG_FILE):
+    # feeds.json 格式：{"feeds": [{"name": "main", "url": "...", "chats": ["-100..."], "forum_url": "可选"}]}
+    if not os.path.exists(path):
+        if not (RSS_FEED_URL and SAFEW_CHAT_ID):
+            return []
+        return [Feed("default", RSS_FEED_URL, [str(SAFEW_CHAT_ID)], FIXED_PROJECT_URL, STATE_DB_FILE)]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"读取订阅配置失败：{str(e)}")
+        return []
+    feeds = []
+    for raw in data.get("feeds", []) if isinstance(data, dict) else []:
+        name = str(raw.get("name") or "").strip() if isinstance(raw, dict) else ""
+        chats = list(dict.fromkeys(str(c) for c in raw.get("chats") or [])) if name else []
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or not raw.get("url") or not chats:
+            logging.error(f"订阅配置无效，已跳过：{raw}")
+            continue
+        if any(feed.name == name for feed in feeds):
+            logging.error(f"订阅名称重复，已跳过：{name}")
+            continue
+        forum_url = raw.get("forum_url") or FIXED_PROJECT_URL
+        feeds.append(Feed(name, raw["url"], chats, forum_url.rstrip("/") + "/", feed_state_file(name)))
+    logging.info(f"已加载订阅配置：{len(feeds)}个RSS，共{sum(len(f.chats) for f in feeds)}个推送目标")
+    return feeds
+
+def open_stores(feeds):
+    stores = []
+    try:
+        for feed in feeds:
+            stores.append(StateStore(feed.state_file, feed.url))
+    except Exception:
+        for store in stores:
+            store.close()
+        raise
+    return stores
 
 # ====================== 主逻辑 =======================
-async def check_for_updates():
-    async with aiohttp.ClientSession() as session:
-        await check_pending_data(session)
-        sent_tids = load_sent_tids()
-        pending_tids = [d["tid"] for d in load_pending_data()]
-        new_entries = fetch_updates(sent_tids, pending_tids)
-        if new_entries:
-            await push_new_posts(session, new_entries[:MAX_PUSH_PER_RUN])
-
-async def main():
+async def run_cycle(http, store, feed, drain=False, prefetched=None):
+    # 单轮检查，返回本轮RSS中发现的新帖数（供常驻模式调整轮询间隔）
+    # drain=True 时不按条数截断，改为在 DRAIN_TIME_BUDGET_SECONDS 内尽量推送
+    started = asyncio.get_running_loop().time()
+    logging.info(f"=== 订阅 {feed.name}：{len(feed.chats)}个推送目标 ===")
+    with metrics.timer("pending_check"):
+        await check_pending_data(http, store, feed)
+    new_entries, feed_validators, feed_max_tid = await fetch_updates(http, store, feed, prefetched)
+    resolved_tids = []
+    if new_entries:
+        if drain:
+            batch = new_entries
+            deadline = started + DRAIN_TIME_BUDGET_SECONDS
+        else:
+            batch = new_entries[:MAX_PUSH_PER_RUN]
+            deadline = None
+        resolved_tids = await push_new_posts(http, store, feed, batch, drain=drain, deadline=deadline)
+        if len(batch) < len(new_entries) or len(resolved_tids) < len(batch):
+            # 还有未处理完的帖子，下次必须重新拉取完整RSS
+            feed_validators = None
+    if feed_validators:
+        store.set_feed_validators(feed_validators)
+    if RSS_INCREMENTAL and new_entries is not None and feed_max_tid:
+        # 高水位只推进到第一条未处理完的新帖之前
+        resolved = set(resolved_tids)
+        unresolved = [e["tid"] for e in new_entries if e["tid"] not in resolved]
+        high_water = min(unresolved) - 1 if unresolved else feed_max_tid
+        if high_water > store.feed_high_water():
+            store.set_feed_high_water(high_water)
+    store.commit()
+    return len(new_entries or [])
+
+async def run_feeds(http, stores, feeds, drain=False, prefetched=None):
+    # 各订阅并发检查，互不影响；返回所有订阅的新帖总数
+    prefetched = prefetched or {}
+    reset_page_requests()
+    results = await asyncio.gather(
+        *(run_cycle(http, store, feed, drain=drain, prefetched=prefetched.get(feed.name))
+          for store, feed in zip(stores, feeds)),
+        return_exceptions=True
+    )
+    new_count = 0
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            logging.error(f"❌ 订阅 {feed.name} 检查异常：{str(result)}")
+        else:
+            new_count += result
+    return new_count
+
+async def check_for_updates(feeds, drain=False):
+    metrics.reset()
+    with metrics.timer("state_load"):
+        stores = open_stores(feeds)
+    try:
+        prefetched = {}
+        active = list(zip(stores, feeds))
+        if QUICK_CHECK:
+            now = int(time.time())
+            with metrics.timer("quick_check"):
+                # urllib是阻塞调用，各订阅放到线程里并发检查，不占住事件循环
+                checks = await asyncio.gather(
+                    *(asyncio.to_thread(quick_feed_check, store, feed, now) for store, feed in active)
+                )
+            active = [pair for pair, (needed, _) in zip(active, checks) if needed]
+            prefetched = {feed.name: body for (_, feed), (_, body) in zip(zip(stores, feeds), checks) if body}
+            if not active:
+                logging.info("无到期待审核帖，RSS也未变化，本轮结束")
+                return
+        async with Transport() as http:
+            with metrics.timer("cycle"):
+                await run_feeds(http, [s for s, _ in active], [f for _, f in active], drain=drain, prefetched=prefetched)
+    finally:
+        for store in stores:
+            store.close()
+        image_cache.flush()
+        page_cache.flush()
+        file_id_cache.flush()
+        shutdown_cpu_executor()
+        metrics.export()
+
+def next_poll_interval(interval, new_count):
+    # 有新帖时回到最短间隔，空闲时逐步拉长
+    if new_count:
+        return POLL_MIN_SECONDS
+    return min(POLL_MAX_SECONDS, max(POLL_MIN_SECONDS, interval * POLL_BACKOFF_FACTOR))
+
+async def run_daemon(feeds, drain=False):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    logging.info(f"常驻模式：轮询间隔{POLL_MIN_SECONDS}~{POLL_MAX_SECONDS}秒")
+    metrics.reset()
+    with metrics.timer("state_load"):
+        stores = open_stores(feeds)
+    interval = POLL_MIN_SECONDS
+    try:
+        async with Transport() as http:
+            while not stop.is_set():
+                new_count = 0
+                try:
+                    with metrics.timer("cycle"):
+                        new_count = await run_feeds(http, stores, feeds, drain=drain)
+                except Exception as e:
+                    logging.error(f"❌ 本轮检查异常：{str(e)}")
+                image_cache.flush()
+                page_cache.flush()
+                file_id_cache.flush()
+                metrics.export()
+                metrics.reset()
+                interval = next_poll_interval(interval, new_count)
+                logging.info(f"本轮新帖{new_count}条，{interval:.0f}秒后再次检查")
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=interval)
+                except asyncio.TimeoutError:
+                    pass
+        logging.info("收到退出信号，已完成当前一轮后退出")
+    finally:
+        for store in stores:
+            store.close()
+        shutdown_cpu_executor()
+
+async def main(daemon=False, drain=False):
     logging.info("===== SafeW RSS推送脚本启动 =====")
-    if not all([SAFEW_BOT_TOKEN, SAFEW_CHAT_ID, RSS_FEED_URL]):
-        logging.error("❌ 缺少环境变量，终止")
+    logging.info(f"脚本目录：{SCRIPT_DIR}")
+    feeds = load_feeds()
+    if not SAFEW_BOT_TOKEN or not feeds:
+        logging.error("❌ 缺少环境变量或订阅配置，终止")
         return
 
-    if not os.path.exists(PENDING_POSTS_FILE):
-        save_pending_data([])
-        logging.info(f"初始化待审核文件：{PENDING_POSTS_FILE}")
-
     try:
-        await check_for_updates()
+        if daemon:
+            await run_daemon(feeds, drain=drain)
+        else:
+            await check_for_updates(feeds, drain=drain)
     except Exception as e:
         logging.error(f"❌ 核心逻辑异常：{str(e)}")
     logging.info("===== 脚本运行结束 =====")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="SafeW RSS推送脚本")
+    parser.add_argument("--daemon", action="store_true", help="常驻运行，按自适应间隔轮询（默认单次运行，供cron调用）")
+    parser.add_argument("--drain", action="store_true", help="积压模式：预取整批帖子，按时间预算而非条数推送")
+    args = parser.parse_args()
+    asyncio.run(main(daemon=args.daemon, drain=args.drain or DRAIN_MODE))
@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import socket
+
+import pytest
+from aiohttp import web
+
+import rss_safew
+
+CHAT = "-1001"
+OTHER_CHAT = "-1002"
+API_PROFILES = {
+    "api": {"limit": 4, "limit_per_host": 4, "connect": 1, "sock_read": 0.3, "total": None, "connect_retries": 0},
+}
+
+@pytest.fixture
+def store(tmp_path):
+    store = rss_safew.StateStore(str(tmp_path / "state.db"), "https://example.com/rss")
+    yield store
+    store.conn.close()
+
+def outbox_rows(store):
+    return sorted(store.conn.execute("SELECT tid, chat_id, state FROM outbox"))
+
+def reopen(store):
+    path, feed_url = store.path, store.feed_url
+    store.conn.close()
+    return rss_safew.StateStore(path, feed_url)
+
+# ---------- 状态库 ----------
+def test_reconcile_marks_interrupted_send_unconfirmed(store):
+    store.outbox_journal([1], CHAT)(True)
+    store = reopen(store)
+    assert outbox_rows(store) == [(1, CHAT, "unconfirmed")]
+    assert store.delivered_chats(1) == {CHAT}
+    store.conn.close()
+
+def test_reconcile_deletes_interrupted_send_when_resend_enabled(store, monkeypatch):
+    monkeypatch.setattr(rss_safew, "OUTBOX_RESEND_UNCONFIRMED", True)
+    store.outbox_journal([1], CHAT)(True)
+    store = reopen(store)
+    assert outbox_rows(store) == []
+    assert store.delivered_chats(1) == set()
+    store.conn.close()
+
+def test_fan_out_skips_delivered_chats(store, monkeypatch):
+    sent_to = []
+
+    async def fake_send_post(http, chat_id, images, caption, tid, journal=None):
+        journal(True)
+        sent_to.append(chat_id)
+        return {"ok": True, "result": {"message_id": 1}}
+
+    monkeypatch.setattr(rss_safew, "send_post", fake_send_post)
+    store.outbox_done([1], CHAT, [10])
+    assert asyncio.run(rss_safew.fan_out(None, store, [CHAT, OTHER_CHAT], [1], [], "caption", 1))
+    assert sent_to == [OTHER_CHAT]
+    assert outbox_rows(store) == [(1, CHAT, "sent"), (1, OTHER_CHAT, "sent")]
+
+def test_mark_sent_removes_outbox_rows_in_same_commit(store):
+    store.outbox_done([1], CHAT, [10])
+    store.outbox_done([2], CHAT, [11])
+    store.mark_sent(1)
+    assert outbox_rows(store) == [(1, CHAT, "sent"), (2, CHAT, "sent")]
+    store.commit()
+    assert outbox_rows(store) == [(2, CHAT, "sent")]
+    assert store.conn.execute("SELECT tid FROM sent_log").fetchall() == [(1,)]
+
+# ---------- SendScheduler.call 的发送日志 ----------
+class FakeApi:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.hits = 0
+
+    async def handle(self, request):
+        await request.read()
+        self.hits += 1
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if reply == "hang":
+            await asyncio.sleep(5)
+        if reply == 429:
+            return web.json_response({"ok": False, "parameters": {"retry_after": 0}}, status=429)
+        if isinstance(reply, int) and reply != 200:
+            return web.json_response({"ok": False, "description": "error"}, status=reply)
+        return web.json_response({"ok": True, "result": {"message_id": 7}})
+
+@contextlib.asynccontextmanager
+async def api_server(fake):
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    finally:
+        await runner.cleanup()
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(rss_safew, "SAFEW_BOT_TOKEN", "test")
+    monkeypatch.setattr(rss_safew, "SEND_BACKOFF_BASE", 0.01)
+    return rss_safew.SendScheduler(6000, 10, 2)
+
+async def journaled_call(scheduler, store, api_base, monkeypatch):
+    monkeypatch.setattr(rss_safew, "SAFEW_API_BASE", api_base)
+    async with rss_safew.Transport(API_PROFILES) as http:
+        return await scheduler.call(
+            http, "sendMessage", 1, lambda: {"json": {"chat_id": CHAT, "text": "hi"}}, CHAT,
+            store.outbox_journal([1], CHAT)
+        )
+
+def run_with_api(replies, scheduler, store, monkeypatch):
+    fake = FakeApi(replies)
+
+    async def run():
+        async with api_server(fake) as base:
+            return await journaled_call(scheduler, store, base, monkeypatch)
+
+    return fake, asyncio.run(run())
+
+def test_call_success_leaves_intent_for_fan_out(scheduler, store, monkeypatch):
+    fake, result = run_with_api([200], scheduler, store, monkeypatch)
+    assert result["result"]["message_id"] == 7
+    assert outbox_rows(store) == [(1, CHAT, "sending")]
+
+def test_call_4xx_clears_intent(scheduler, store, monkeypatch):
+    fake, result = run_with_api([400], scheduler, store, monkeypatch)
+    assert result is None
+    assert fake.hits == 1
+    assert outbox_rows(store) == []
+
+def test_call_429_clears_intent_and_retries(scheduler, store, monkeypatch):
+    fake, result = run_with_api([429, 200], scheduler, store, monkeypatch)
+    assert result is not None
+    assert fake.hits == 2
+
+def test_call_5xx_is_unconfirmed_without_retry(scheduler, store, monkeypatch):
+    with pytest.raises(rss_safew.SendUnconfirmed):
+        run_with_api([502, 200], scheduler, store, monkeypatch)
+    assert outbox_rows(store) == [(1, CHAT, "sending")]
+
+def test_call_5xx_still_retries_without_journal(scheduler, monkeypatch):
+    fake = FakeApi([502, 200])
+
+    async def run():
+        async with api_server(fake) as base:
+            monkeypatch.setattr(rss_safew, "SAFEW_API_BASE", base)
+            async with rss_safew.Transport(API_PROFILES) as http:
+                return await scheduler.call(http, "sendMessage", 1, lambda: {"json": {}}, CHAT)
+
+    assert asyncio.run(run()) is not None
+    assert fake.hits == 2
+
+def test_call_connect_error_clears_intent(scheduler, store, monkeypatch):
+    result = asyncio.run(journaled_call(scheduler, store, f"http://127.0.0.1:{unused_port()}", monkeypatch))
+    assert result is None
+    assert outbox_rows(store) == []
+
+def test_call_timeout_after_send_raises_unconfirmed(scheduler, store, monkeypatch):
+    with pytest.raises(rss_safew.SendUnconfirmed):
+        fake, _ = run_with_api(["hang"], scheduler, store, monkeypatch)
+    assert outbox_rows(store) == [(1, CHAT, "sending")]
+
+def test_fan_out_records_unconfirmed_send(scheduler, store, monkeypatch):
+    fake = FakeApi(["hang"])
+    monkeypatch.setattr(rss_safew, "send_scheduler", scheduler)
+
+    async def run():
+        async with api_server(fake) as base:
+            monkeypatch.setattr(rss_safew, "SAFEW_API_BASE", base)
+            async with rss_safew.Transport(API_PROFILES) as http:
+                return await rss_safew.fan_out(http, store, [CHAT], [1], [], "caption", 1)
+
+    assert asyncio.run(run()) is True
+    assert fake.hits == 1
+    assert outbox_rows(store) == [(1, CHAT, "unconfirmed")]
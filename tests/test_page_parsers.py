@@ -0,0 +1,105 @@
+import os
+import re
+
+import pytest
+
+import rss_safew
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+PAGE_URL = "https://tyw29.cc/thread-123456.htm"
+SAMPLES = sorted(name[:-5] for name in os.listdir(PAGES_DIR) if name.endswith(".html"))
+BACKENDS = [
+    "stream",
+    pytest.param("selectolax", marks=pytest.mark.skipif(
+        rss_safew.importlib.util.find_spec("selectolax") is None, reason="selectolax未安装")),
+    "bs4",
+]
+
+def load_page(name):
+    with open(os.path.join(PAGES_DIR, f"{name}.html"), encoding="utf-8") as f:
+        return f.read()
+
+def baseline_parse(html, webpage_url):
+    # 改为流式解析前 get_post_status 里的整页BeautifulSoup逻辑，作为对照基准
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    audit_pattern = re.compile(r"本帖正在审核中.*您无权查看", re.DOTALL | re.UNICODE)
+    for h4_tag in soup.find_all("h4", class_=re.compile(r"card-title")):
+        if audit_pattern.search(h4_tag.get_text(strip=True)):
+            return [], True
+    if audit_pattern.search(html):
+        return [], True
+    target_divs = soup.find_all("div", class_="message break-all", isfirst="1") or \
+        soup.find_all("div", class_="message break-all")
+    images = []
+    base_domain = "/".join(webpage_url.split("/")[:3])
+    for div in target_divs:
+        for img in div.find_all("img"):
+            img_url = img.get("data-src", "").strip() or img.get("src", "").strip()
+            if not img_url or img_url.startswith(("data:image/", "javascript:")):
+                continue
+            if img_url.startswith("/"):
+                img_url = f"{base_domain}{img_url}"
+            elif not img_url.startswith(("http", "https")):
+                img_url = f"{base_domain}/{img_url}"
+            if img_url not in images and img_url.startswith(("http", "https")):
+                images.append(img_url)
+    return images, False
+
+@pytest.mark.parametrize("sample", SAMPLES)
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_backend_matches_stream(sample, backend):
+    html = load_page(sample)
+    assert rss_safew.parse_post_page(html, PAGE_URL, backend) == rss_safew.parse_post_page(html, PAGE_URL, "stream")
+
+@pytest.mark.parametrize("sample", SAMPLES)
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_backend_matches_baseline(sample, backend):
+    # 基准实现找不到正文div时返回空列表，新实现返回None，由 get_post_status 统一处理
+    html = load_page(sample)
+    images, is_pending = rss_safew.parse_post_page(html, PAGE_URL, backend)
+    assert (images or [], is_pending) == baseline_parse(html, PAGE_URL)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_first_post_only(backend):
+    images, is_pending = rss_safew.parse_post_page(load_page("first_post"), PAGE_URL, backend)
+    assert not is_pending
+    assert images == [
+        "https://tyw29.cc/upload/attach/202410/1_AAAA.jpg",
+        "https://tyw29.cc/upload/attach/202410/1_BBBB.png",
+        "https://img.example.com/pic/cccc.webp",
+    ]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_audit_page(backend):
+    assert rss_safew.parse_post_page(load_page("audit"), PAGE_URL, backend) == ([], True)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_no_isfirst_falls_back_to_all_posts(backend):
+    images, _ = rss_safew.parse_post_page(load_page("no_isfirst"), PAGE_URL, backend)
+    assert images == [f"https://tyw29.cc/upload/attach/old/{i}.jpg" for i in (1, 2, 3)]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_no_post_div(backend):
+    assert rss_safew.parse_post_page(load_page("no_post_div"), PAGE_URL, backend) == (None, False)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_nested_divs(backend):
+    images, _ = rss_safew.parse_post_page(load_page("nested_divs"), PAGE_URL, backend)
+    assert images[:4] == [f"https://tyw29.cc/upload/attach/nested/{i}.jpg" for i in (1, 2, 3, 4)]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_data_src_preferred_over_src(backend):
+    images, _ = rss_safew.parse_post_page(load_page("data_src"), PAGE_URL, backend)
+    assert images == [
+        "https://tyw29.cc/upload/attach/lazy/1.jpg",
+        "https://img.example.com/lazy/2.jpg",
+        "https://tyw29.cc/upload/attach/lazy/3.jpg",
+        "https://tyw29.cc/upload/attach/lazy/4.jpg",
+        "https://tyw29.cc/upload/attach/lazy/5.jpg",
+    ]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_div_close_inside_script(backend):
+    images, _ = rss_safew.parse_post_page(load_page("script_div"), PAGE_URL, backend)
+    assert images == [f"https://tyw29.cc/upload/attach/script/{i}.jpg" for i in (1, 2)]
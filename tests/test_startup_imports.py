@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("aiohttp", "feedparser", "bs4", "selectolax")
+# 只在解析帖子页/RSS或上传图片时用到，无新帖的运行不应加载
+LAZY_STDLIB_MODULES = ("html.parser", "xml.etree.ElementTree", "uuid", "hashlib", "random")
+
+def imported_after_import():
+    code = "import json, sys, rss_safew; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    return set(json.loads(result.stdout.strip().splitlines()[-1]))
+
+def test_import_does_not_load_heavy_dependencies():
+    assert not imported_after_import() & set(HEAVY_MODULES)
+
+def test_import_does_not_load_parsing_or_upload_modules():
+    assert not imported_after_import() & set(LAZY_STDLIB_MODULES)